@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+# An in-process fake of the parts of the Packet API used by the plugin.
+
+import datetime
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def timestamp(t: float) -> str:
+    return datetime.datetime.utcfromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FakePacketAPI:
+    """Simulate devices, their events, SSH keys and batches over HTTP.
+
+    Devices go through queued, provisioning and active within
+    ``provision_time`` seconds of their creation; a ``fail_rate`` fraction
+    of them ends up failed instead.  Every response is delayed by
+    ``latency`` seconds and a ``throttle_rate`` fraction of the calls is
+    answered with HTTP 429.  Calls are counted per endpoint.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        fail_rate: float = 0.0,
+        provision_time: float = 20.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.fail_rate = fail_rate
+        self.provision_time = provision_time
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.devices: Dict[str, Dict[str, Any]] = {}
+        self.ssh_keys: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, List[str]] = {}
+        self._addresses = 0
+        self._server: Optional[http.server.ThreadingHTTPServer] = None
+
+    # Lifecycle
+
+    def start(self) -> str:
+        api = self
+
+        class Handler(RequestHandler):
+            fake = api
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:{0}".format(self._server.server_address[1])
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def total_calls(self) -> int:
+        with self.lock:
+            return sum(self.calls.values())
+
+    # Devices
+
+    def _stages(self, d: Dict[str, Any]) -> List[Tuple[float, str]]:
+        """Return the (time, state) transitions of a device."""
+        t = d["created"]
+        final = "failed" if d["fails"] else "active"
+        return [
+            (t, "queued"),
+            (t + 0.1 * self.provision_time, "provisioning"),
+            (t + self.provision_time, final),
+        ]
+
+    def _state(self, d: Dict[str, Any], now: float) -> Tuple[str, Optional[float]]:
+        state = "queued"
+        for at, s in self._stages(d):
+            if now >= at:
+                state = s
+        if state != "provisioning":
+            return state, None
+        done = (now - d["created"]) / self.provision_time
+        return state, round(100.0 * done, 2)
+
+    def _address(self) -> int:
+        self._addresses += 1
+        return self._addresses
+
+    def create_device(self, project: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        n = self._address()
+        facility = params.get("facility")
+        if isinstance(facility, list):
+            facility = facility[0]
+        d = {
+            "id": str(uuid.uuid4()),
+            "hostname": params["hostname"],
+            "project": project,
+            "plan": params.get("plan"),
+            "facility": facility,
+            "operating_system": params.get("operating_system"),
+            "tags": params.get("tags") or [],
+            "created": time.time(),
+            "fails": self.random.random() < self.fail_rate,
+            "ipv4": "10.{0}.{1}.{2}".format(n >> 16 & 255, n >> 8 & 255, n & 255),
+            "n": n,
+        }
+        self.devices[d["id"]] = d
+        return d
+
+    def device_json(self, d: Dict[str, Any]) -> Dict[str, Any]:
+        state, percentage = self._state(d, time.time())
+        data: Dict[str, Any] = {
+            "id": d["id"],
+            "hostname": d["hostname"],
+            "state": state,
+            "tags": d["tags"],
+            "created_at": timestamp(d["created"]),
+            "operating_system": {"slug": d["operating_system"]},
+            "facility": {"code": d["facility"]},
+            "plan": {"slug": d["plan"]},
+            "project": {"href": "/projects/{0}".format(d["project"])},
+            "provisioning_percentage": percentage,
+            "ip_addresses": [],
+        }
+        if state in ("provisioning", "active"):
+            data["ip_addresses"] = [
+                {
+                    "public": True,
+                    "address_family": 4,
+                    "address": d["ipv4"],
+                    "gateway": "10.255.255.254",
+                    "cidr": 31,
+                },
+                {
+                    "public": True,
+                    "address_family": 6,
+                    "address": "2604:1380::{0:x}".format(d["n"]),
+                    "gateway": "2604:1380::1",
+                    "cidr": 127,
+                },
+                {
+                    "public": False,
+                    "address_family": 4,
+                    "address": "172.16.{0}.{1}".format(d["n"] >> 8 & 255, d["n"] & 255),
+                    "gateway": "172.16.255.254",
+                    "cidr": 31,
+                },
+            ]
+        return data
+
+    def events_json(self, d: Dict[str, Any]) -> List[Dict[str, Any]]:
+        now = time.time()
+        events = [
+            {
+                "id": "{0}-{1}".format(d["id"], state),
+                "type": "instance.{0}".format(state),
+                "state": state,
+                "created_at": timestamp(at),
+                "interpolated": "device {0} is {1}".format(d["hostname"], state),
+            }
+            for at, state in self._stages(d)
+            if now >= at
+        ]
+        return list(reversed(events))
+
+
+def paginate(items: List[Any], key: str, query: Dict[str, str]) -> Dict[str, Any]:
+    page = int(query.get("page", 1))
+    per_page = int(query.get("per_page", 10))
+    start = (page - 1) * per_page
+    data: Dict[str, Any] = {key: items[start : start + per_page]}  # noqa: E203
+    if start + per_page < len(items):
+        data["meta"] = {"next": {"href": "?page={0}".format(page + 1)}}
+    return data
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake: FakePacketAPI
+
+    routes = [
+        ("GET", r"devices/([^/]+)", "get_device"),
+        ("PUT", r"devices/([^/]+)", "update_device"),
+        ("DELETE", r"devices/([^/]+)", "delete_device"),
+        ("GET", r"devices/([^/]+)/events", "device_events"),
+        ("GET", r"projects/([^/]+)/devices", "list_devices"),
+        ("POST", r"projects/([^/]+)/devices", "create_device"),
+        ("POST", r"projects/([^/]+)/devices/batch", "create_batch"),
+        ("GET", r"batches/([^/]+)", "get_batch"),
+        ("DELETE", r"batches/([^/]+)", "delete_batch"),
+        ("POST", r"projects/([^/]+)/ssh-keys", "create_ssh_key"),
+        ("GET", r"projects/([^/]+)/ssh-keys", "list_ssh_keys"),
+        ("GET", r"ssh-keys", "list_ssh_keys"),
+        ("GET", r"ssh-keys/([^/]+)", "get_ssh_key"),
+        ("DELETE", r"ssh-keys/([^/]+)", "delete_ssh_key"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def reply(self, status: int, data: Any = None, headers=None) -> None:
+        body = b"" if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method: str) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.strip("/")
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        params = json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+        fake = self.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            self.reply(404, {"errors": ["Not found"]})
+            return
+
+        with fake.lock:
+            endpoint = "{0} {1}".format(method, pattern)
+            fake.calls[endpoint] = fake.calls.get(endpoint, 0) + 1
+            if fake.random.random() < fake.throttle_rate:
+                status: int = 429
+                data: Any = {"errors": ["Too Many Requests"]}
+                headers = {"Retry-After": "1"}
+            else:
+                status, data = getattr(self, name)(*match.groups(), query, params)
+                headers = {}
+        self.reply(status, data, headers)
+
+    # Handlers, called with the fake's lock held
+
+    def get_device(self, device_id, query, params):
+        d = self.fake.devices.get(device_id)
+        if d is None:
+            return 404, {"errors": ["Not found"]}
+        return 200, self.fake.device_json(d)
+
+    def update_device(self, device_id, query, params):
+        d = self.fake.devices.get(device_id)
+        if d is None:
+            return 404, {"errors": ["Not found"]}
+        for k in ("hostname", "tags"):
+            if k in params:
+                d[k] = params[k]
+        return 200, self.fake.device_json(d)
+
+    def delete_device(self, device_id, query, params):
+        d = self.fake.devices.get(device_id)
+        if d is None:
+            return 404, {"errors": ["Not found"]}
+        if self.fake._state(d, time.time())[0] in ("queued", "provisioning"):
+            return 422, {"errors": ["Cannot delete a device while it is provisioning"]}
+        del self.fake.devices[device_id]
+        return 204, None
+
+    def device_events(self, device_id, query, params):
+        d = self.fake.devices.get(device_id)
+        if d is None:
+            return 404, {"errors": ["Not found"]}
+        return 200, paginate(self.fake.events_json(d), "events", query)
+
+    def list_devices(self, project, query, params):
+        devices = [
+            self.fake.device_json(d)
+            for d in self.fake.devices.values()
+            if d["project"] == project
+        ]
+        if "tag" in query:
+            devices = [d for d in devices if query["tag"] in (d.get("tags") or [])]
+        return 200, paginate(devices, "devices", query)
+
+    def create_device(self, project, query, params):
+        d = self.fake.create_device(project, params)
+        return 201, self.fake.device_json(d)
+
+    def create_batch(self, project, query, params):
+        batches = []
+        for batch in params["batches"]:
+            ids = [
+                self.fake.create_device(project, dict(batch, hostname=hostname))["id"]
+                for hostname in batch["hostnames"]
+            ]
+            batch_id = str(uuid.uuid4())
+            self.fake.batches[batch_id] = ids
+            batches.append({"id": batch_id, "state": "queued"})
+        return 201, {"batches": batches}
+
+    def get_batch(self, batch_id, query, params):
+        ids = self.fake.batches.get(batch_id)
+        if ids is None:
+            return 404, {"errors": ["Not found"]}
+        devices = [
+            self.fake.device_json(self.fake.devices[i])
+            for i in ids
+            if i in self.fake.devices
+        ]
+        return 200, {"id": batch_id, "state": "completed", "devices": devices}
+
+    def delete_batch(self, batch_id, query, params):
+        ids = self.fake.batches.pop(batch_id, None)
+        if ids is None:
+            return 404, {"errors": ["Not found"]}
+        if query.get("remove_associated_instances") == "true":
+            for i in ids:
+                self.fake.devices.pop(i, None)
+        return 204, None
+
+    def create_ssh_key(self, project, query, params):
+        key = {
+            "id": str(uuid.uuid4()),
+            "label": params.get("label"),
+            "key": params.get("key"),
+            "fingerprint": "fake:{0}".format(len(self.fake.ssh_keys)),
+            "project": project,
+        }
+        self.fake.ssh_keys[key["id"]] = key
+        return 201, key
+
+    def list_ssh_keys(self, *args):
+        query = args[-2]
+        project = args[0] if len(args) == 3 else None
+        keys = [
+            k
+            for k in self.fake.ssh_keys.values()
+            if project is None or k["project"] == project
+        ]
+        return 200, paginate(keys, "ssh_keys", query)
+
+    def get_ssh_key(self, key_id, query, params):
+        key = self.fake.ssh_keys.get(key_id)
+        if key is None:
+            return 404, {"errors": ["Not found"]}
+        return 200, key
+
+    def delete_ssh_key(self, key_id, query, params):
+        if self.fake.ssh_keys.pop(key_id, None) is None:
+            return 404, {"errors": ["Not found"]}
+        return 204, None
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Measure what loading the plugin costs every nixops invocation.
+
+Imports the plugin and the modules it registers with nixops (what nixops
+does on every command, Packet related or not) in a fresh interpreter, a
+few times, and reports the median wall time and the slowest imports from
+``python -X importtime``.  Fails if any module which should only be
+loaded once a Packet resource is used got imported.  Run from the
+repository root:
+
+  python benchmarks/import_time.py
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded by the Packet SDK or the backend helpers, never on registration
+DEFERRED = [
+    "packet",
+    "requests",
+    "urllib3",
+    "asyncio",
+    "nixops_packet.utils",
+    "nixops_packet.fleet",
+    "nixops_packet.catalog",
+    "nixops_packet.readiness",
+]
+
+REGISTER = """
+import importlib, sys, argparse
+import logging.handlers  # imported by nixops before loading plugins
+import nixops_packet.plugin as p
+plugin = p.plugin()
+for name in plugin.load():
+    importlib.import_module(name)
+parser = argparse.ArgumentParser()
+plugin.parser(parser, parser.add_subparsers())
+print(" ".join(sorted(m for m in {0!r} if m in sys.modules)))
+""".format(
+    DEFERRED
+)
+
+
+def register(importtime: bool = False) -> Tuple[float, str, str]:
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    start = time.monotonic()
+    proc = subprocess.run(
+        cmd + ["-c", REGISTER],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return time.monotonic() - start, proc.stdout.strip(), proc.stderr
+
+
+def slowest(importtime: str, count: int) -> List[Tuple[int, str]]:
+    """Return the imports with the largest cumulative time, in µs."""
+    imports = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [f.strip() for f in line[12:].split("|")]
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args(argv)
+
+    times = [register()[0] for _ in range(args.runs)]
+    _, loaded, importtime = register(importtime=True)
+    print(
+        "plugin registration: median {0:.3f}s over {1} runs (min {2:.3f}s)".format(
+            statistics.median(times), args.runs, min(times)
+        )
+    )
+    print("slowest imports (cumulative):")
+    for cumulative, name in slowest(importtime, args.top):
+        print("  {0:>9.1f} ms  {1}".format(cumulative / 1000.0, name))
+    if loaded:
+        print("deferred modules imported on registration: {0}".format(loaded))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
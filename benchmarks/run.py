@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the plugin's API-facing paths against a local fake Packet API.
+
+For every fleet size a fresh fake API and nixops state file are used to
+run, with one thread per resource as nixops does:
+
+  keypair    PacketKeyPairState.create
+  provision  PacketState.provision_device (create, wait_for_state "active")
+  check      PacketState.get_reconciled_device
+  destroy    PacketState.destroy
+
+and the wall time and number of API calls of each phase are reported
+along with the peak RSS of the process.  Machines are never reached over
+SSH.  Run from the repository root, e.g.:
+
+  python benchmarks/run.py --machines 1 10 100 --latency 0.05 2>/dev/null
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), HERE]
+
+from fakeapi import FakePacketAPI  # noqa: E402
+
+PROJECT = "bench-project"
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--machines", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--provision-time", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--json", metavar="PATH", help="also write the results as JSON lines"
+    )
+    return parser.parse_args(argv)
+
+
+def open_deployment(path: str):
+    import nixops.statefile
+
+    try:
+        sf = nixops.statefile.StateFile(path, writable=True)
+    except TypeError:
+        # nixops before read-only state files
+        sf = nixops.statefile.StateFile(path)
+    depl = sf.create_deployment()
+    depl.logger.set_autoresponse("y")
+    return depl
+
+
+def definition(cls, **attrs):
+    """Return a resource definition with the given attributes, bypassing nix."""
+    defn = cls.__new__(cls)
+    for k, v in attrs.items():
+        setattr(defn, k, v)
+    return defn
+
+
+def parallel(resources: List[Any], fn: Callable[[Any], None]) -> List[str]:
+    """Run fn for all resources from one thread each; return the failures."""
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max(1, len(resources))) as pool:
+        futures = {pool.submit(fn, r): r for r in resources}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                failures.append("{0}: {1}".format(futures[future].name, error))
+    return failures
+
+
+def run(n: int, args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    from nixops_packet.backends.device import PacketDefinition
+    from nixops_packet.resources.keypair import PacketKeyPairDefinition
+
+    api = FakePacketAPI(
+        latency=args.latency,
+        throttle_rate=args.throttle_rate,
+        fail_rate=args.fail_rate,
+        provision_time=args.provision_time,
+        seed=args.seed,
+    )
+    os.environ["PACKET_API_URL"] = api.start()
+    # Clients, pollers and batches are shared per token: isolate each run
+    token = "bench-token-{0}".format(n)
+    depl = open_deployment(os.path.join(workdir, "bench-{0}.nixops".format(n)))
+
+    with depl._db:
+        keypair = depl._create_resource("bench-key", "packet-keypair")
+        machines = [
+            depl._create_resource("machine-{0}".format(i), "packet") for i in range(n)
+        ]
+    keypair_defn = definition(
+        PacketKeyPairDefinition,
+        name="bench-key",
+        keypair_name="bench-key",
+        access_key_id=token,
+        project=PROJECT,
+    )
+    machine_defn = definition(
+        PacketDefinition,
+        access_key_id=token,
+        key_pair="bench-key",
+        tags={},
+        facility="ams1",
+        plan="c3.small.x86",
+        project=PROJECT,
+        nixosVersion="nixos_20_03",
+        operating_system="nixos_20_03",
+        ipxe_script_url="",
+        customData=None,
+        storage=None,
+        always_pxe=None,
+        spotInstance=False,
+        spotPriceMax="",
+        reservationId=None,
+    )
+    for m in machines:
+        m.accessKeyId = token
+
+    def create_keypair(kp):
+        kp.create(keypair_defn, check=False, allow_reboot=False, allow_recreate=False)
+
+    def check(m):
+        if m.vm_id is not None:
+            m.get_reconciled_device()
+
+    def destroy(m):
+        if not m.destroy(wipe=False):
+            raise Exception("not destroyed")
+
+    phases = [
+        ("keypair", [keypair], create_keypair),
+        ("provision", machines, lambda m: m.provision_device(machine_defn)),
+        ("check", machines, check),
+        ("destroy", machines, destroy),
+    ]
+    results = []
+    try:
+        for phase, resources, fn in phases:
+            calls = api.total_calls()
+            start = time.monotonic()
+            failures = parallel(resources, fn)
+            results.append(
+                {
+                    "machines": n,
+                    "phase": phase,
+                    "seconds": round(time.monotonic() - start, 3),
+                    "api_calls": api.total_calls() - calls,
+                    "failures": len(failures),
+                    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                }
+            )
+            for failure in failures[:5]:
+                sys.stderr.write("{0} {1}\n".format(phase, failure))
+    finally:
+        api.stop()
+    return results
+
+
+def main(argv: List[str]) -> None:
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="nixops-packet-bench-")
+    # Keep ~/.ssh/known_hosts and the catalog cache out of the benchmark
+    os.environ["HOME"] = workdir
+    os.environ.setdefault("PACKET_CATALOG", "0")
+
+    print(
+        "{0:>8} {1:<10} {2:>10} {3:>10} {4:>9} {5:>12}".format(
+            "machines", "phase", "seconds", "api calls", "failures", "peak rss kB"
+        )
+    )
+    out = open(args.json, "a") if args.json else None
+    for n in args.machines:
+        for r in run(n, args, workdir):
+            print(
+                "{machines:>8} {phase:<10} {seconds:>10.2f} {api_calls:>10} "
+                "{failures:>9} {peak_rss_kb:>12}".format(**r)
+            )
+            if out is not None:
+                out.write(json.dumps(r) + "\n")
+        sys.stdout.flush()
+    if out is not None:
+        out.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Check that SSH master connections outlive a nixops invocation.
+
+Runs a command on a host through nixops_packet.sshmux.MultiplexedSSH, the
+SSH object Packet machines use with PACKET_SSH_MULTIPLEX=1, from several
+fresh interpreters in a row, as successive nixops invocations would.  The
+first one starts the master connection; every later one must find it
+running and reuse its socket.  Reports the time of each invocation and
+fails if a later one had to connect again.  Needs a host accepting SSH
+logins, e.g.:
+
+  python benchmarks/ssh_reuse.py 147.75.0.1 -i ~/.ssh/id_ed25519
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INVOCATION = """
+import json, sys
+import logging.handlers  # imported by nixops before loading plugins
+import nixops.logger
+import nixops_packet.sshmux as sshmux
+prefix, host, flags = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+ssh = sshmux.MultiplexedSSH(
+    nixops.logger.Logger(sys.stderr).get_logger_for("ssh-reuse"), lambda: prefix
+)
+ssh.register_host_fun(lambda: host)
+ssh.register_flag_fun(lambda: flags)
+ssh.run_command("true", logged=False)
+print(json.dumps(ssh.get_master().reused))
+"""
+
+
+def invoke(prefix: str, host: str, flags: List[str]) -> Tuple[float, bool]:
+    start = time.monotonic()
+    proc = subprocess.run(
+        [sys.executable, "-c", INVOCATION, prefix, host, json.dumps(flags)],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return time.monotonic() - start, json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("host")
+    parser.add_argument("-i", dest="identity", help="SSH private key")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    import logging.handlers  # noqa: F401, imported by nixops before loading plugins
+    import nixops_packet.sshmux as sshmux
+
+    flags = ["-o", "StrictHostKeyChecking=accept-new"]
+    if args.identity:
+        flags += ["-i", args.identity]
+    prefix = sshmux.control_prefix("ssh-reuse", args.host, None)
+    sshmux.ensure_control_dir()
+    sshmux.close(prefix)
+    failed = False
+    try:
+        for run in range(args.runs):
+            seconds, reused = invoke(prefix, args.host, flags)
+            print(
+                "invocation {0}: {1:.3f}s, {2}".format(
+                    run + 1, seconds, "reused master" if reused else "new master"
+                )
+            )
+            failed = failed or (run > 0 and not reused)
+    finally:
+        sshmux.close(prefix)
+    if failed:
+        print("a later invocation didn't reuse the master connection")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
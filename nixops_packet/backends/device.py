@@ -13,19 +13,36 @@ from nixops.resources import ResourceOptions
 from nixops.backends import MachineDefinition, MachineState, MachineOptions
 from nixops.nix_expr import nix2py
 import nixops.util
-import nixops.known_hosts
-import nixops_packet.utils as packet_utils
+import nixops_packet.lazy as packet_lazy
 import nixops_packet.resources
-import socket
-import packet
+import concurrent.futures
 import json
-import getpass
-from typing import cast, Dict, Mapping, Optional, Any
-from datetime import datetime
+from typing import Dict, Mapping, Optional, Any
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Only loaded once a Packet machine is actually used
+packet = packet_lazy.module("packet")
+packet_utils = packet_lazy.module("nixops_packet.utils")
+packet_poller = packet_lazy.module("nixops_packet.poller")
+packet_events = packet_lazy.module("nixops_packet.events")
+packet_fleet = packet_lazy.module("nixops_packet.fleet")
+packet_hostkeys = packet_lazy.module("nixops_packet.hostkeys")
+packet_instrument = packet_lazy.module("nixops_packet.instrument")
+packet_batch = packet_lazy.module("nixops_packet.batch")
+packet_pool = packet_lazy.module("nixops_packet.pool")
+packet_provision = packet_lazy.module("nixops_packet.provision")
+packet_catalog = packet_lazy.module("nixops_packet.catalog")
+packet_provstore = packet_lazy.module("nixops_packet.provstore")
+packet_reservations = packet_lazy.module("nixops_packet.reservations")
+packet_sshmux = packet_lazy.module("nixops_packet.sshmux")
+packet_readiness = packet_lazy.module("nixops_packet.readiness")
+packet_scheduler = packet_lazy.module("nixops_packet.scheduler")
+packet_timings = packet_lazy.module("nixops_packet.timings")
+socket = packet_lazy.module("socket")
+getpass = packet_lazy.module("getpass")
+
 
 class PacketMachineOptions(ResourceOptions):
     accessKeyId: Optional[str]
@@ -102,8 +119,15 @@ class PacketState(MachineState[PacketDefinition]):
         "packet.ipxeScriptUrl", None
     )
     facility: Optional[str] = nixops.util.attr_property("packet.facility", None)
+    # Where the device actually is, which "any" facility doesn't tell
+    facility_code: Optional[str] = nixops.util.attr_property(
+        "packet.facilityCode", None
+    )
     plan: Optional[str] = nixops.util.attr_property("packet.plan", None)
-    provSystem: Optional[str] = nixops.util.attr_property("packet.provSystem", None)
+    project: Optional[str] = nixops.util.attr_property("packet.project", None)
+    provSystem_hash: Optional[str] = nixops.util.attr_property(
+        "packet.provSystemHash", None
+    )
     metadata: Optional[str] = nixops.util.attr_property("packet.metadata", None)
     public_ipv4: str = nixops.util.attr_property("publicIpv4", None)
     public_ipv6: Optional[str] = nixops.util.attr_property("publicIpv6", None)
@@ -117,13 +141,47 @@ class PacketState(MachineState[PacketDefinition]):
     public_cidrv6: Optional[str] = nixops.util.attr_property("publicCidrv6", None, int)
     private_cidr: Optional[str] = nixops.util.attr_property("privateCidr", None, int)
     public_host_key: str = nixops.util.attr_property("publicHostKey", None)
+    last_event_id: Optional[str] = nixops.util.attr_property("packet.lastEventId", None)
+    reservation_id: Optional[str] = nixops.util.attr_property(
+        "packet.hardwareReservationId", None
+    )
+    # Milestones of the last bring-up, see nixops_packet.timings
+    timings: Optional[Dict[str, Any]] = nixops.util.attr_property(
+        "packet.timings", None, "json"
+    )
 
     def __init__(self, depl: nixops.deployment.Deployment, name: str, id):
         MachineState.__init__(self, depl, name, id)
         self.name = name
         self._conn = None
+        if packet_sshmux.enabled():
+            self.ssh = packet_sshmux.MultiplexedSSH(
+                self.logger, self.get_ssh_control_prefix
+            )
+            self.ssh.register_flag_fun(self.get_ssh_flags)
+            self.ssh.register_host_fun(self.get_ssh_name)
+            self.ssh.register_passwd_fun(self.get_ssh_password)
         # print(self.provSystem)
 
+    @property
+    def provSystem(self) -> Optional[str]:
+        """The captured system.nix, stored once per deployment by content."""
+        if self.provSystem_hash:
+            return packet_provstore.load(self.depl, self.provSystem_hash)
+        # State written before system.nix files were content addressed
+        return self._get_attr("packet.provSystem", None)
+
+    @provSystem.setter
+    def provSystem(self, value: Optional[str]) -> None:
+        old_hash = self.provSystem_hash
+        with self.depl._db:
+            self.provSystem_hash = (
+                None if value is None else packet_provstore.store(self.depl, value)
+            )
+            self._set_attr("packet.provSystem", None)
+            if old_hash and old_hash != self.provSystem_hash:
+                packet_provstore.release(self.depl, old_hash)
+
     def get_ssh_name(self) -> str:
         if not self.public_ipv4:
             raise Exception(
@@ -140,10 +198,13 @@ class PacketState(MachineState[PacketDefinition]):
     def show_type(self):
         s = super(PacketState, self).show_type()
         if self.facility:
-            s = "{0} [{1}; {2}]".format(s, self.facility, self.plan)
+            s = "{0} [{1}; {2}]".format(
+                s, self.facility_code or self.facility, self.plan
+            )
         return s
 
     def connect(self):
+        packet_instrument.set_machine(self.name)
         if self._conn:
             return self._conn
         if not self.accessKeyId:
@@ -151,6 +212,45 @@ class PacketState(MachineState[PacketDefinition]):
         self._conn = packet_utils.connect(self.accessKeyId)
         return self._conn
 
+    def get_device(self, max_age=None):
+        """Return a snapshot of the device, preferably from the project poller."""
+        assert self.vm_id is not None
+        if max_age is None:
+            max_age = packet_poller.DEFAULT_MAX_AGE
+        if self.project is None:
+            return self.connect().get_device(self.vm_id)
+        poller = packet_poller.get(self.connect(), self.project)
+        if max_age <= 0:
+            # No snapshot is fresh enough, and listing the project won't
+            # give one either: fetch the device alone
+            instance = self.connect().get_device(self.vm_id)
+            poller.remember(instance)
+            return instance
+        instance = poller.device(self.vm_id, max_age)
+        if instance is None:
+            # Not listed (yet): let the API tell us whether the device is gone
+            instance = self.connect().get_device(self.vm_id)
+            poller.remember(instance)
+        return instance
+
+    def invalidate_device(self, deleted: bool = False) -> None:
+        """Drop the cached snapshot of the device after changing it."""
+        if self.vm_id is not None and self.project is not None:
+            poller = packet_poller.get(self.connect(), self.project)
+            if deleted:
+                poller.discard(self.vm_id)
+            else:
+                poller.invalidate(self.vm_id)
+
+    def get_event_journal(self) -> str:
+        """Return the path of the JSONL journal of this machine's device events."""
+        return os.path.join(
+            os.path.dirname(os.path.abspath(self.depl._db.db_file)),
+            "packet-events",
+            self.depl.uuid,
+            "{0}.jsonl".format(self.name),
+        )
+
     def get_ssh_private_key_file(self) -> Optional[str]:
         if self._ssh_private_key_file:
             return self._ssh_private_key_file
@@ -167,14 +267,47 @@ class PacketState(MachineState[PacketDefinition]):
             super_flags
             + (["-i", file] if file else [])
             + ["-o", "StrictHostKeyChecking=accept-new"]
+            + (
+                ["-o", "UserKnownHostsFile=" + packet_hostkeys.path(self.depl)]
+                if packet_hostkeys.deployment_scoped()
+                else []
+            )
         )
 
-    def get_sos_ssh_name(self) -> str:
-        instance = self.connect().get_device(self.vm_id)
-        return "sos.{}.packet.net".format(instance.facility["code"])
+    def get_ssh_control_prefix(self) -> str:
+        return packet_sshmux.control_prefix(
+            self.depl.uuid, self.name, self.public_host_key
+        )
+
+    def close_ssh_master(self) -> None:
+        """Close the persistent SSH connections to this machine, if any."""
+        if packet_sshmux.enabled():
+            packet_sshmux.close(self.get_ssh_control_prefix())
 
-    def op_sos_console(self) -> None:
-        ssh = nixops.ssh_util.SSH(self.logger)
+    def get_sos_ssh_name(self) -> str:
+        if self.facility_code is None:
+            # Machines deployed by older versions don't have it recorded
+            self.update_state(self.get_device())
+        return "sos.{}.packet.net".format(self.facility_code)
+
+    def op_sos_console(self, refresh: bool = False, offline: bool = False) -> None:
+        """Connect to the SOS console, using the facility recorded in state.
+
+        With refresh the device is fetched from the API first; offline
+        fails instead of calling the API when the facility isn't recorded.
+        """
+        if refresh:
+            self.update_state(self.get_device(max_age=0))
+        elif offline and self.facility_code is None:
+            raise Exception(
+                "the facility of Packet machine ‘{0}’ isn't recorded; run without ‘--offline’ once".format(
+                    self.name
+                )
+            )
+        if packet_sshmux.enabled():
+            ssh = packet_sshmux.MultiplexedSSH(self.logger, self.get_ssh_control_prefix)
+        else:
+            ssh = nixops.ssh_util.SSH(self.logger)
         ssh.register_flag_fun(self.get_ssh_flags)
         ssh.register_host_fun(self.get_sos_ssh_name)
         flags, command = ssh.split_openssh_args([])
@@ -192,9 +325,17 @@ class PacketState(MachineState[PacketDefinition]):
                     public_key
                 ]
             },
-            "imports": [nix2py(self.provSystem if self.provSystem else "{}")],
+            "imports": [self.get_provSystem_expr()],
         }
 
+    def get_provSystem_expr(self):
+        provSystem = self.provSystem
+        if not provSystem:
+            return nix2py("{}")
+        if self.provSystem_hash:
+            return packet_provstore.parse(self.provSystem_hash, provSystem)
+        return nix2py(provSystem)
+
     def get_physical_spec(self):
         if self.key_pair is None and self.plan is not None:
             raise Exception("Key Pair is not set")
@@ -226,6 +367,8 @@ class PacketState(MachineState[PacketDefinition]):
         return tags
 
     def destroy(self, wipe=False):
+        if packet_fleet.bulk_destroy_enabled():
+            return packet_fleet.destroyer(self.depl).destroy(self)
         if self.plan is not None:
             self.connect()
         if not self.depl.logger.confirm(
@@ -237,7 +380,7 @@ class PacketState(MachineState[PacketDefinition]):
         self.log("destroying instance {}".format(self.vm_id))
         try:
             if self.vm_id is not None:
-                instance = self.connect().get_device(self.vm_id)
+                instance = self.get_device()
                 instance.delete()
         except packet.baseapi.Error as e:
             if e.args[0] == "Error 401: Invalid authentication token":
@@ -265,9 +408,27 @@ class PacketState(MachineState[PacketDefinition]):
                 raise e
             else:
                 raise e
-        nixops.known_hosts.remove(self.public_ipv4, self.public_host_key)
+        self.forget_device()
         return True
 
+    def forget_device(self):
+        """Clean up the state and local files left by a destroyed device."""
+        self.forget_device_state()
+        self.clean_up_device()
+
+    def forget_device_state(self) -> None:
+        # Drop the stored system.nix unless other machines share it
+        self.provSystem = None
+
+    def clean_up_device(self) -> None:
+        """Drop the host key, cached snapshot and SSH connections of a device.
+
+        Runs SSH, so it is kept out of state transactions.
+        """
+        packet_hostkeys.remove(self.depl, self.public_ipv4, self.public_host_key)
+        self.invalidate_device(deleted=True)
+        self.close_ssh_master()
+
     def create(self, defn, check, allow_reboot, allow_recreate):
         assert isinstance(defn, PacketDefinition)
         self.accessKeyId = defn.access_key_id
@@ -277,22 +438,20 @@ class PacketState(MachineState[PacketDefinition]):
             check = True
 
         self.set_common_state(defn)
+        if self.project is None:
+            self.project = defn.project
         self.vm_id: Optional[str]
         if self.vm_id and check:
             try:
-                instance = self.connect().get_device(self.vm_id)
+                instance = self.get_reconciled_device()
             except packet.baseapi.Error as e:
                 if e.args[0] == "Error 404: Not found":
                     instance = None
-                    self.vm_id = None
-                    self.state = MachineState.MISSING
-                    self.ssh_pinged = False
-                    self._ssh_pinged_this_time = False
-                    nixops.known_hosts.remove(self.public_ipv4, self.public_host_key)
                 else:
                     raise e
 
             if instance is None:
+                self.forget_vanished_device()
                 if not allow_recreate:
                     raise Exception(
                         "Packet.net instance ‘{0}’ went away; deploy with ‘--allow-recreate’ to create a new one".format(
@@ -300,9 +459,6 @@ class PacketState(MachineState[PacketDefinition]):
                         )
                     )
 
-            if instance:
-                self.update_state(instance)
-
         if not self.vm_id:
             if (
                 self.state == self.MISSING
@@ -319,21 +475,79 @@ class PacketState(MachineState[PacketDefinition]):
         # Ensure periodic API instance health checks while waiting for ssh
         self.wait_for_ssh_nixops_packet(check=True)
 
-        if self.metadata is None or self.provSystem is None:
+        if not self.metadata or self.provSystem is None:
             self.update_provSystem(check=False)
 
+    def get_reconciled_device(self):
+        """Return the device as listed by the deployment's reconciliation pass.
+
+        The state of the machine is updated from the listing; None is
+        returned if the device went away.
+        """
+        if self.project is None:
+            instance = self.connect().get_device(self.vm_id)
+            self.update_state(instance)
+            return instance
+        return packet_fleet.reconciler(self.depl).device(self)
+
+    def forget_vanished_device(self):
+        self.vm_id = None
+        self.state = MachineState.MISSING
+        self.ssh_pinged = False
+        self._ssh_pinged_this_time = False
+        packet_hostkeys.remove(self.depl, self.public_ipv4, self.public_host_key)
+
+    def _check(self, res):
+        if self.vm_id is None:
+            res.exists = False
+            return
+        if not self.accessKeyId:
+            self.warn("no API token is set, cannot check the Packet.net device")
+            return
+        try:
+            instance = self.get_reconciled_device()
+        except packet.baseapi.Error as e:
+            if e.args[0] == "Error 404: Not found":
+                instance = None
+            else:
+                raise e
+        if instance is None:
+            self.forget_vanished_device()
+            res.exists = False
+            return
+        res.exists = True
+        res.is_up = self.state == self.UP
+        if res.is_up:
+            super()._check(res)
+
     def op_update_provSystem(self) -> None:
         self.update_provSystem()
 
+    def is_legacy_nixos(self) -> bool:
+        return self.ipxe_script_url == "" and self.nixos_version in [
+            "nixos_18_03",
+            "nixos_19_03",
+        ]
+
+    def missing_system_nix(self) -> Exception:
+        return Exception(
+            "\n".join(
+                [
+                    f"System provisioning file not found on machine {self.name} at /etc/nixos/packet/system.nix.",
+                    "Try using a packet supported nixosVersion or ipxeScriptUrl which provides the required system provisioning file.",
+                ]
+            )
+        )
+
     def update_provSystem(self, check=True) -> None:
         self.wait_for_ssh_nixops_packet(check=check)
+        if packet_provision.enabled():
+            self.capture_provSystem()
+            return
         self.update_metadata()
 
         # Custom build and patch the system.nix provisioning file if a legacy NixOS version
-        if self.ipxe_script_url == "" and self.nixos_version in [
-            "nixos_18_03",
-            "nixos_19_03",
-        ]:
+        if self.is_legacy_nixos():
 
             # Assemble a system.nix provisioning file from the nix files left by the provisioning script
             self.log("Building system provisioning file for legacy nixosVersion")
@@ -415,14 +629,7 @@ class PacketState(MachineState[PacketDefinition]):
 
         # Raise if system.nix isn't found and the machine isn't a known NixOS version since we don't otherwise know the physical spec
         elif self.run_command("test -r /etc/nixos/packet/system.nix", check=False) == 1:
-            raise Exception(
-                "\n".join(
-                    [
-                        f"System provisioning file not found on machine {self.name} at /etc/nixos/packet/system.nix.",
-                        "Try using a packet supported nixosVersion or ipxeScriptUrl which provides the required system provisioning file.",
-                    ]
-                )
-            )
+            raise self.missing_system_nix()
 
         provSystem = self.run_command(
             "cat /etc/nixos/packet/system.nix",
@@ -430,22 +637,76 @@ class PacketState(MachineState[PacketDefinition]):
             logged=True,
             capture_stdout=True,
         )
-        self.provSystem = "\n".join(
-            [
-                line
-                for line in provSystem.splitlines()
-                if not line.lstrip().startswith("#")
-            ]
+        public_host_key = self.run_command(
+            "cat /etc/ssh/ssh_host_ed25519_key.pub", check=False, capture_stdout=True,
         )
+        self.set_provSystem(provSystem, public_host_key.strip())
+
+    def capture_provSystem(self) -> None:
+        """Capture metadata, system.nix and the host key in one SSH session.
+
+        The legacy system.nix assembly and patches are applied locally on the
+        captured files instead of by separate remote commands.
+        """
+        self.apply_capture(
+            packet_provision.parse_capture(
+                self.run_command(
+                    packet_provision.CAPTURE_SCRIPT,
+                    check=True,
+                    logged=False,
+                    capture_stdout=True,
+                )
+            )
+        )
+
+    def apply_capture(self, capture) -> None:
+        """Set metadata, system.nix and the host key from a capture."""
+        self.metadata = capture.metadata
+        self.log("Metadata captured")
+        logger.debug(self.metadata)
+
+        if self.is_legacy_nixos():
+            self.log("Building system provisioning file for legacy nixosVersion")
+            provSystem = packet_provision.assemble_legacy_system(capture.files)
+
+            self.log("Removing legacy SSH key definitions and initialHashedPasswords")
+            provSystem = packet_provision.strip_legacy_credentials(provSystem)
+
+            nics = json.loads(self.metadata)["network"]["interfaces"]
+            macAddress = [nic for nic in nics if "mac" in nic][0]["mac"]
+            self.log(f"Obtained a physical nic MAC address: {macAddress}")
+            self.log(
+                "Applying a physical nic MAC address to a bond interface, if defined"
+            )
+            provSystem = packet_provision.patch_bond_mac(provSystem, macAddress)
+
+            if self.plan == "c2.medium.x86":
+                self.log(
+                    f"Patching the c2.medium.x86 boot device name to a boot device UUID ({capture.boot_uuid}) to avoid random reboot failures"
+                )
+                provSystem = packet_provision.patch_boot_uuid(
+                    provSystem, capture.boot_uuid
+                )
+
+        elif "system.nix" not in capture.files:
+            raise self.missing_system_nix()
+        else:
+            provSystem = capture.files["system.nix"]
+
+        self.set_provSystem(provSystem, capture.host_key)
+
+    def set_provSystem(self, provSystem: str, public_host_key: str) -> None:
+        self.provSystem = packet_provision.strip_comments(provSystem)
         self.log("System provisioning file captured")
+        self.mark_timing("captured")
         logger.debug(self.provSystem)
 
-        public_host_key = self.run_command(
-            "cat /etc/ssh/ssh_host_ed25519_key.pub", check=False, capture_stdout=True,
-        )
-        self.public_host_key = public_host_key.strip()
-        nixops.known_hosts.update(
-            self.public_ipv4, self.public_ipv4, self.public_host_key
+        if public_host_key != self.public_host_key:
+            # Connections made to the old host key must not be reused
+            self.close_ssh_master()
+        self.public_host_key = public_host_key
+        packet_hostkeys.update(
+            self.depl, self.public_ipv4, self.public_ipv4, self.public_host_key
         )
         self.log("System public host key captured")
         logger.debug(self.public_host_key)
@@ -455,8 +716,15 @@ class PacketState(MachineState[PacketDefinition]):
         self.connect()
 
         if self.vm_id is not None:
-            instance = self.connect().get_device(self.vm_id)
-            instance.reinstall()
+            self.connect().call_api(
+                "devices/%s/actions" % self.vm_id,
+                type="POST",
+                params={"type": "reinstall"},
+            )
+            self.invalidate_device()
+            self.start_timings(
+                "reinstall", self.plan, self.facility_code or self.facility
+            )
 
         self.log_start("waiting for the machine to go down ...")
         self.wait_for_ssh_nixops_packet()
@@ -464,7 +732,8 @@ class PacketState(MachineState[PacketDefinition]):
         self._ssh_pinged_this_time = False
         self.ssh_pinged = False
         self.ssh.reset()
-        nixops.known_hosts.remove(self.public_ipv4, self.public_host_key)
+        self.close_ssh_master()
+        packet_hostkeys.remove(self.depl, self.public_ipv4, self.public_host_key)
 
         self.wait_for_state("provisioning")
         self.wait_for_state("active")
@@ -472,12 +741,12 @@ class PacketState(MachineState[PacketDefinition]):
         self.wait_for_ssh_nixops_packet(check=True)
         self.log_end("[up]")
 
-        self.update_state(self.connect().get_device(self.vm_id))
+        self.update_state(self.get_device())
 
         self.log("{}".format(self.public_ipv4))
 
         self.update_provSystem(check=False)
-        self.update_state(self.connect().get_device(self.vm_id))
+        self.update_state(self.get_device())
 
     def update_metadata(self) -> None:
         metadata: str = self.run_command(
@@ -492,21 +761,33 @@ class PacketState(MachineState[PacketDefinition]):
         logger.debug(self.metadata)
 
     def update_state(self, instance):
-        self.state = self.packetstate2state(instance.state)
+        values: Dict[str, Any] = {"state": self.packetstate2state(instance.state)}
+        if isinstance(instance.facility, dict) and instance.facility.get("code"):
+            values["facility_code"] = instance.facility["code"]
+            record = self.timings
+            if record is not None and record["facility"] != values["facility_code"]:
+                # Machines asking for "any" facility land in a specific one
+                values["timings"] = dict(record, facility=values["facility_code"])
         addresses = instance.ip_addresses
         for address in addresses:
             if address["public"] and address["address_family"] == 4:
-                self.public_ipv4 = address["address"]
-                self.default_gateway = address["gateway"]
-                self.public_cidr = address["cidr"]
+                values["public_ipv4"] = address["address"]
+                values["default_gateway"] = address["gateway"]
+                values["public_cidr"] = address["cidr"]
             if address["public"] and address["address_family"] == 6:
-                self.public_ipv6 = address["address"]
-                self.default_gatewayv6 = address["gateway"]
-                self.public_cidrv6 = address["cidr"]
+                values["public_ipv6"] = address["address"]
+                values["default_gatewayv6"] = address["gateway"]
+                values["public_cidrv6"] = address["cidr"]
             if not address["public"] and address["address_family"] == 4:
-                self.private_ipv4 = address["address"]
-                self.private_gateway = address["gateway"]
-                self.private_cidr = address["cidr"]
+                values["private_ipv4"] = address["address"]
+                values["private_gateway"] = address["gateway"]
+                values["private_cidr"] = address["cidr"]
+        # Only write what changed, in one transaction: this runs on every poll
+        changed = {k: v for k, v in values.items() if getattr(self, k) != v}
+        if changed:
+            with self.depl._db:
+                for k, v in changed.items():
+                    setattr(self, k, v)
         logger.debug(
             '{0} state: {{ "{1}": {2} }}'.format(
                 self.name, self.show_state(), self.state
@@ -527,21 +808,29 @@ class PacketState(MachineState[PacketDefinition]):
 
     def findKeypairResource(
         self, key_pair_name
-    ) -> Optional[nixops_packet.resources.keypair.PacketKeyPairState]:
-        for r in self.depl.active_resources.values():
-            if isinstance(r, nixops_packet.resources.keypair.PacketKeyPairState):
-                key = cast(nixops_packet.resources.keypair.PacketKeyPairState, r)
-                if (
-                    key.keypair_name == key_pair_name
-                    and key.state
-                    == nixops_packet.resources.keypair.PacketKeyPairState.UP
-                ):
-                    return key
-
-        return None
+    ) -> Optional["nixops_packet.resources.keypair.PacketKeyPairState"]:
+        return nixops_packet.resources.keypair.keypair_index(self.depl).keypair(
+            key_pair_name
+        )
 
     def create_device(self, defn, check, allow_reboot, allow_recreate):
+        captured = self.provision_device(defn)
+
+        self._ssh_pinged_this_time = False
+        self.ssh_pinged = False
+        if not captured:
+            self.update_provSystem(check=True)
+        self.update_state(self.get_device())
+
+    def provision_device(self, defn) -> bool:
+        """Create the device of this machine and wait until it is active.
+
+        Returns whether the provisioning state of the device was captured
+        already, which is the case for spares claimed from the warm pool.
+        """
         self.connect()
+        if packet_catalog.enabled():
+            packet_catalog.validate(defn)
         kp = self.findKeypairResource(defn.key_pair)
         assert kp is not None
         common_tags = self.get_common_tags()
@@ -549,18 +838,29 @@ class PacketState(MachineState[PacketDefinition]):
         tags.update(defn.tags)
         tags.update(common_tags)
         self.log_start("creating packet device ...")
+        self.start_timings("create", defn.plan, defn.facility)
         self.log("project: '{0}'".format(defn.project))
         self.log("facility: {0}".format(defn.facility))
         self.log("keyid: {0}".format(kp.keypair_id))
-        instance = self.connect().create_device(
+        facilities = [defn.facility]
+        if packet_catalog.enabled():
+            facilities = packet_catalog.select_facilities(defn)
+        reservation_id = defn.reservationId
+        if reservation_id == packet_reservations.NEXT_AVAILABLE:
+            reservation_id, facility = packet_reservations.assigner(
+                self.depl
+            ).reservation(self, defn)
+            facilities = [facility]
+            self.log("hardware reservation: {0}".format(reservation_id))
+        args: Dict[str, Any] = dict(
             project_id=defn.project,
             hostname="{0}".format(self.name),
             plan=defn.plan,
-            facility=[defn.facility],
+            facility=facilities,
             operating_system=defn.operating_system,
             user_ssh_keys=[],
             project_ssh_keys=[kp.keypair_id],
-            hardware_reservation_id=defn.reservationId,
+            hardware_reservation_id=reservation_id,
             spot_instance=defn.spotInstance,
             storage=None
             if defn.storage is None
@@ -577,52 +877,108 @@ class PacketState(MachineState[PacketDefinition]):
             ipxe_script_url=defn.ipxe_script_url,
             always_pxe=defn.always_pxe,
         )
+        pool_key = None
+        if packet_pool.enabled():
+            pool_key = packet_pool.pool_key(defn, kp.keypair_id)
+        if pool_key is not None:
+            pool = packet_pool.get(self.connect(), defn.project)
+            claimed = pool.claim(pool_key, self.name, packet_utils.dict2tags(tags))
+            if claimed is not None:
+                pool.refill(
+                    pool_key,
+                    packet_pool.spare_args(defn, kp.keypair_id),
+                    kp.private_key,
+                )
+                instance, captured = claimed
+                self.log("claimed spare device {0}".format(instance.id))
+                self.start_timings("claim", defn.plan, defn.facility)
+                self.set_device(defn, instance)
+                self.update_state(instance)
+                if captured is not None:
+                    self.apply_capture(captured)
+                self.log("{}".format(self.public_ipv4))
+                return captured is not None
+
+        with packet_batch.facility_slot(defn.facility):
+            if packet_batch.enabled():
+                instance = packet_batch.get(self.connect(), defn.project).create(
+                    self.name, packet_batch.batch_item(args)
+                )
+            else:
+                instance = self.connect().create_device(**args)
+
+            self.set_device(defn, instance)
+            # The response to the creation is the device's first snapshot
+            packet_poller.get(self.connect(), defn.project).remember(instance)
+            self.update_state(self.get_device())
 
+            self.log("instance is in {} state".format(instance.state))
+
+            self.wait_for_state("active")
+
+        self.update_state(self.get_device())
+
+        self.log("{}".format(self.public_ipv4))
+        return False
+
+    def set_device(self, defn, instance) -> None:
+        """Record the device created or claimed for this machine."""
         self.vm_id = instance.id
         assert self.vm_id is not None
+        self.last_event_id = None
         self.key_pair = defn.key_pair
+        nixops_packet.resources.keypair.keypair_index(self.depl).invalidate()
         self.facility = defn.facility
         self.plan = defn.plan
+        self.project = defn.project
         self.accessKeyId = defn.access_key_id
         self.nixos_version = defn.nixosVersion
         self.ipxe_script_url = defn.ipxe_script_url
         self.log("instance id: " + self.vm_id)
-        self.update_state(self.connect().get_device(self.vm_id))
-
-        self.log("instance is in {} state".format(instance.state))
-
-        self.wait_for_state("active")
 
-        self.update_state(self.connect().get_device(self.vm_id))
+    def start_timings(
+        self, kind: str, plan: Optional[str], facility: Optional[str]
+    ) -> None:
+        self.timings = packet_timings.start(kind, plan, facility)
 
-        self.log("{}".format(self.public_ipv4))
+    def mark_timing(self, phase: str) -> None:
+        record = self.timings
+        if record is not None and packet_timings.mark(record, phase):
+            self.timings = record
 
-        self._ssh_pinged_this_time = False
-        self.ssh_pinged = False
-        self.update_provSystem(check=True)
-        self.update_state(self.connect().get_device(self.vm_id))
+    def record_timing(self, instance) -> None:
+        """Note the milestone and progress of a bring-up shown by a snapshot."""
+        record = self.timings
+        if record is None:
+            return
+        changed = False
+        if instance.state in packet_timings.PHASES:
+            changed = packet_timings.mark(record, instance.state)
+        if instance.state == "provisioning":
+            percentage = getattr(instance, "provisioning_percentage", None)
+            changed = packet_timings.progress(record, percentage) or changed
+        if changed:
+            self.timings = record
 
     def wait_for_state(self, target_state: str) -> None:
-        ts = None
-        last_ts = None
         self.log_start(
             "waiting for the machine to enter the state '{}' ...".format(target_state)
         )
+        assert self.vm_id is not None
+        cursor = packet_events.EventCursor(
+            self.connect(), self.vm_id, self.last_event_id, self.get_event_journal()
+        )
+        # Journal what happened so far, only events from now on are logged
+        cursor.poll()
+        delay: float = packet_scheduler.MIN_INTERVAL
         while True:
-            instance = self.connect().get_device(self.vm_id)
-
-            # Events are returned pre-sorted in a list by descending chronological order
-            events = self.connect().list_device_events(self.vm_id)
-            next_ts = datetime.utcnow()
-            if ts is None:
-                if len(events) > 0:
-                    ts = datetime.strptime(events[0].created_at, "%Y-%m-%dT%H:%M:%SZ")
-                else:
-                    ts = datetime.utcnow()
-            else:
-                ts = last_ts
+            instance = self.get_device(max_age=delay)
+            events = cursor.poll()
+            if cursor.last_id != self.last_event_id:
+                self.last_event_id = cursor.last_id
 
             self.update_state(instance)
+            self.record_timing(instance)
             if (
                 instance.state == "provisioning"
                 and hasattr(instance, "provisioning_percentage")
@@ -636,15 +992,7 @@ class PacketState(MachineState[PacketDefinition]):
             else:
                 self.log("instance is in {} state".format(instance.state))
 
-            # Select new device events
-            filtered = list(
-                filter(
-                    lambda e: datetime.strptime(e.created_at, "%Y-%m-%dT%H:%M:%SZ")
-                    > (ts or datetime(1970, 1, 1)),
-                    events,
-                )
-            )
-            for event in reversed(filtered):
+            for event in events:
                 self.log(f"{event.created_at} -- {event}")
 
             if instance.state == target_state:
@@ -654,15 +1002,19 @@ class PacketState(MachineState[PacketDefinition]):
                 self.state = MachineState.MISSING
                 self.ssh_pinged = False
                 self._ssh_pinged_this_time = False
-                nixops.known_hosts.remove(self.public_ipv4, self.public_host_key)
+                packet_hostkeys.remove(
+                    self.depl, self.public_ipv4, self.public_host_key
+                )
                 raise Exception(
                     "Packet.net failed to provision ‘{0}’; deploy with ‘--allow-recreate’ to create a new one".format(
                         self.name
                     )
                 )
             else:
-                last_ts = next_ts
-                time.sleep(10)
+                delay = packet_scheduler.poll_interval(
+                    instance.state, getattr(instance, "provisioning_percentage", None)
+                )
+                time.sleep(delay)
 
     def wait_for_ssh_nixops_packet(self, check=False):
         logger.debug(f"{self.name} wait_for_ssh_nixops_packet check = {check}")
@@ -672,17 +1024,37 @@ class PacketState(MachineState[PacketDefinition]):
         )
         if self.ssh_pinged and (not check or self._ssh_pinged_this_time):
             return
+        # Host keys removed from known_hosts must be gone before connecting
+        packet_hostkeys.flush(packet_hostkeys.path(self.depl))
         self.log_start("waiting for SSH...")
 
         # Create a callback object with a 60 second API health check interval
         packet_health = PacketHealth(60)
-        self.wait_for_up(callback=lambda: packet_health.check(self))
+        if packet_readiness.enabled():
+            self.wait_for_ssh_ready(callback=lambda: packet_health.check(self))
+        else:
+            self.wait_for_up(callback=lambda: packet_health.check(self))
 
         self.log_end("")
         if self.state != self.RESCUE:
             self.state = self.UP
         self.ssh_pinged = True
         self._ssh_pinged_this_time = True
+        self.mark_timing("ssh-up")
+
+    def wait_for_ssh_ready(self, callback) -> None:
+        """Wait for the SSH banner of the machine through the shared prober."""
+        port = getattr(self, "ssh_port", None) or 22
+        ready = packet_readiness.get().submit(self.get_ssh_name(), port)
+        try:
+            while True:
+                try:
+                    ready.result(timeout=packet_scheduler.MIN_INTERVAL)
+                    return
+                except concurrent.futures.TimeoutError:
+                    callback()
+        finally:
+            ready.cancel()
 
 
 class PacketHealth:
@@ -703,7 +1075,7 @@ class PacketHealth:
                     )
                 )
             try:
-                instance = packet_self.connect().get_device(packet_self.vm_id)
+                instance = packet_self.get_device(max_age=self.interval)
             except packet.baseapi.Error as e:
                 if e.args[0] == "Error 404: Not found":
                     instance = None
@@ -711,8 +1083,10 @@ class PacketHealth:
                     packet_self.state = MachineState.MISSING
                     packet_self.ssh_pinged = False
                     packet_self._ssh_pinged_this_time = False
-                    nixops.known_hosts.remove(
-                        packet_self.public_ipv4, packet_self.public_host_key
+                    packet_hostkeys.remove(
+                        packet_self.depl,
+                        packet_self.public_ipv4,
+                        packet_self.public_host_key,
                     )
                 else:
                     raise e
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+# Creation of many devices through the project batch-device API.
+
+import contextlib
+import os
+import threading
+import time
+import packet
+import nixops_packet.gather as packet_gather
+import nixops_packet.scheduler as packet_scheduler
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds the first machine of a group waits for others to join its batch.
+DEFAULT_WINDOW = 2.0
+
+# Seconds to wait for the API to turn a batch into devices.
+BATCH_TIMEOUT = 600
+
+_creators: Dict[Tuple[str, str], "BatchCreator"] = {}
+_facility_slots: Dict[str, threading.BoundedSemaphore] = {}
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.environ.get("PACKET_BATCH_CREATE", "") not in ("", "0")
+
+
+def window() -> float:
+    return float(os.environ.get("PACKET_BATCH_WINDOW", DEFAULT_WINDOW))
+
+
+def max_per_facility() -> Optional[int]:
+    value = os.environ.get("PACKET_BATCH_MAX_PER_FACILITY")
+    return int(value) if value else None
+
+
+@contextlib.contextmanager
+def facility_slot(facility: str):
+    """Limit the number of devices of one facility being brought up at once."""
+    limit = max_per_facility()
+    if limit is None:
+        yield
+        return
+    with _lock:
+        slots = _facility_slots.get(facility)
+        if slots is None:
+            slots = threading.BoundedSemaphore(limit)
+            _facility_slots[facility] = slots
+    with slots:
+        yield
+
+
+def batch_item(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Translate packet.Manager.create_device arguments into a batch entry.
+
+    Mirrors the request body built by create_device, without the per device
+    hostname and the project, which are given by the batch itself.
+    """
+    item: Dict[str, Any] = {
+        "plan": args["plan"],
+        "operating_system": args["operating_system"],
+        "project_ssh_keys": args["project_ssh_keys"],
+        "user_ssh_keys": args["user_ssh_keys"],
+        "tags": args["tags"],
+        "facility": args["facility"],
+        "hardware_reservation_id": args["hardware_reservation_id"],
+    }
+    if args["storage"]:
+        item["storage"] = args["storage"]
+    if args["customdata"]:
+        item["customdata"] = args["customdata"]
+    if args["ipxe_script_url"] != "":
+        item["always_pxe"] = args["always_pxe"]
+        item["ipxe_script_url"] = args["ipxe_script_url"]
+        item["operating_system"] = "custom_ipxe"
+    if args["spot_instance"]:
+        item["spot_instance"] = args["spot_instance"]
+        item["spot_price_max"] = args["spot_price_max"]
+    return item
+
+
+class BatchCreator:
+    """Collect concurrent device creations and submit them as one request.
+
+    Machines are deployed from parallel threads.  The first machine of a
+    project asking for a device waits a short window for the others, then
+    all of them are created with a single batch request holding one batch
+    per machine, with the machine's own hostname, specification and tags.
+    Every machine gets its own device back, or the error of its batch.
+    """
+
+    def __init__(self, manager, project_id: str, window: float = DEFAULT_WINDOW):
+        self.manager = manager
+        self.project_id = project_id
+        self._gatherer = packet_gather.Gatherer(window, self._submit)
+
+    def create(self, hostname: str, item: Dict[str, Any]) -> packet.Device:
+        return self._gatherer.submit(self.project_id, (hostname, item))
+
+    def _submit(self, key: str, group: List[Tuple[str, Dict[str, Any]]]) -> List[Any]:
+        logger.debug(
+            "project {0}: creating batch of {1} devices".format(
+                self.project_id, len(group)
+            )
+        )
+        data = self.manager.call_api(
+            "projects/%s/devices/batch" % self.project_id,
+            type="POST",
+            params={
+                "batches": [
+                    dict(item, hostnames=[hostname], quantity=1)
+                    for hostname, item in group
+                ]
+            },
+        )
+        batch_ids = [b["id"] for b in data["batches"]]
+        results = self._wait_for_devices(batch_ids)
+        return [
+            self._device(hostname, batch_id, results[batch_id])
+            for (hostname, _), batch_id in zip(group, batch_ids)
+        ]
+
+    def _device(self, hostname: str, batch_id: str, result: Any) -> Any:
+        if not isinstance(result, Exception):
+            for d in result:
+                if d["hostname"] == hostname:
+                    return packet.Device(d, self.manager)
+            result = Exception(
+                "Packet.net batch did not create a device for ‘{0}’".format(hostname)
+            )
+        return self._discard(batch_id, result)
+
+    def _discard(self, batch_id: str, error: Exception) -> Exception:
+        """Delete a failed batch with any device it created or still creates.
+
+        Such devices aren't recorded in the state of any machine.  Returns
+        the error to raise for the machine, naming the batch if it couldn't
+        be deleted.
+        """
+        try:
+            self.manager.call_api(
+                "batches/%s?remove_associated_instances=true" % batch_id, type="DELETE",
+            )
+        except packet.baseapi.Error as e:
+            logger.warning("unable to delete batch {0}: {1}".format(batch_id, e))
+            return Exception(
+                "{0}; devices of batch {1} may be left over and have to be deleted".format(
+                    error, batch_id
+                )
+            )
+        return error
+
+    def _wait_for_devices(self, batch_ids: List[str]) -> Dict[str, Any]:
+        """Return the devices of every batch, or the exception it failed with."""
+        deadline = time.time() + BATCH_TIMEOUT
+        results: Dict[str, Any] = {}
+        while True:
+            for batch_id in batch_ids:
+                if batch_id in results:
+                    continue
+                try:
+                    data = self.manager.call_api(
+                        "batches/%s" % batch_id, params={"include": "devices"}
+                    )
+                except packet.baseapi.Error as e:
+                    logger.debug("polling batch {0}: {1}".format(batch_id, e))
+                    continue
+                if data.get("state") == "failed":
+                    results[batch_id] = Exception(
+                        "Packet.net failed to create batch {0}: {1}".format(
+                            batch_id, ", ".join(data.get("error_messages") or [])
+                        )
+                    )
+                    continue
+                devices = [d for d in data.get("devices") or [] if "hostname" in d]
+                if devices or data.get("state") == "completed":
+                    results[batch_id] = devices
+            if len(results) == len(batch_ids):
+                return results
+            if time.time() > deadline:
+                for batch_id in batch_ids:
+                    results.setdefault(
+                        batch_id,
+                        Exception(
+                            "timed out waiting for Packet.net batch {0}".format(
+                                batch_id
+                            )
+                        ),
+                    )
+                return results
+            time.sleep(packet_scheduler.MIN_INTERVAL)
+
+
+def get(manager, project_id: str) -> BatchCreator:
+    """Return the process wide batch creator for a project."""
+    key = (manager.auth_token, project_id)
+    with _lock:
+        creator = _creators.get(key)
+        if creator is None:
+            creator = BatchCreator(manager, project_id, window())
+            _creators[key] = creator
+        return creator
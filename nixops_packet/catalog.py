@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of the Packet catalog: plans, facilities, operating systems
+# and capacity.
+
+import json
+import os
+import os.path
+import threading
+import time
+import nixops_packet.utils as packet_utils
+from typing import Any, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Plans, facilities and operating systems rarely change.
+DEFAULT_TTL = 24 * 3600
+
+# Capacity changes all the time, but a few minutes old is good enough to
+# reject a sold out facility before provisioning.
+CAPACITY_TTL = 600
+
+# Capacity levels in order of preference.
+CAPACITY_LEVELS = ["normal", "limited"]
+
+# section name -> (API path, collection key, identifying field)
+SECTIONS = {
+    "plans": ("plans", "plans", "slug"),
+    "facilities": ("facilities", "facilities", "code"),
+    "operating_systems": ("operating-systems", "operating_systems", "slug"),
+}
+
+_catalogs: Dict[str, "Catalog"] = {}
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.environ.get("PACKET_CATALOG", "1") != "0"
+
+
+def cache_path() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "nixops-packet", "catalog.json")
+
+
+def ttl() -> float:
+    return float(os.environ.get("PACKET_CATALOG_TTL", DEFAULT_TTL))
+
+
+class Catalog:
+    """The Packet catalog, refreshed from the API once its entries expire.
+
+    Each section is stored with the time it was fetched and the ETag of the
+    response, so an expired section is revalidated with a conditional
+    request and only downloaded again when it actually changed.
+    """
+
+    def __init__(self, manager, path: str, ttl: float = DEFAULT_TTL):
+        self.manager = manager
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: Optional[Dict[str, Any]] = None
+
+    def _load(self) -> Dict[str, Any]:
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = "{0}.{1}".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self._data, f, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def _section(self, name: str, path: str, ttl: float, extract) -> Any:
+        with self._lock:
+            data = self._load()
+            entry = data.get(name)
+            if entry and time.time() - entry["fetched_at"] < ttl:
+                return entry["value"]
+            raw, etag = self.manager.fetch(path, entry.get("etag") if entry else None)
+            value = entry["value"] if raw is None and entry else extract(raw)
+            data[name] = {"fetched_at": time.time(), "etag": etag, "value": value}
+            self._save()
+            return value
+
+    def slugs(self, name: str) -> List[str]:
+        path, key, field = SECTIONS[name]
+        return self._section(
+            name,
+            path,
+            self.ttl,
+            lambda raw: sorted(
+                set(item[field] for item in raw[key] if item.get(field))
+            ),
+        )
+
+    def capacity(self) -> Dict[str, Dict[str, Any]]:
+        return self._section(
+            "capacity", "capacity", CAPACITY_TTL, lambda raw: raw["capacity"]
+        )
+
+    def capacity_level(self, facility: str, plan: str) -> Optional[str]:
+        return ((self.capacity().get(facility) or {}).get(plan) or {}).get("level")
+
+    def facilities_with_capacity(self, plan: str) -> List[str]:
+        """Return the facilities able to provide a plan, best capacity first."""
+        ranked = [
+            (CAPACITY_LEVELS.index(level), facility)
+            for facility, plans in self.capacity().items()
+            for level in [((plans or {}).get(plan) or {}).get("level")]
+            if level in CAPACITY_LEVELS
+        ]
+        return [facility for _, facility in sorted(ranked)]
+
+    def select_facilities(self, defn) -> List[str]:
+        """Return the facilities to ask for when creating a device of defn."""
+        if defn.facility == "any" and not defn.reservationId:
+            facilities = self.facilities_with_capacity(defn.plan)
+            if facilities:
+                return facilities
+        return [defn.facility]
+
+    def check(self, defn) -> List[str]:
+        """Return the problems of a PacketDefinition found in the catalog."""
+        errors = []
+        if defn.plan not in self.slugs("plans"):
+            errors.append("unknown plan ‘{0}’".format(defn.plan))
+        if defn.facility != "any" and defn.facility not in self.slugs("facilities"):
+            errors.append("unknown facility ‘{0}’".format(defn.facility))
+        if defn.operating_system not in self.slugs("operating_systems"):
+            errors.append(
+                "unknown operating system ‘{0}’".format(defn.operating_system)
+            )
+        if errors or defn.reservationId:
+            # Reserved hardware isn't part of the public capacity
+            return errors
+        if defn.facility == "any":
+            if not self.facilities_with_capacity(defn.plan):
+                errors.append(
+                    "no facility has capacity for plan ‘{0}’".format(defn.plan)
+                )
+        elif self.capacity_level(defn.facility, defn.plan) == "unavailable":
+            errors.append(
+                "facility ‘{0}’ has no capacity for plan ‘{1}’".format(
+                    defn.facility, defn.plan
+                )
+            )
+        return errors
+
+
+def get(api_token) -> Catalog:
+    """Return the process wide catalog, read through the given token."""
+    with _lock:
+        catalog = _catalogs.get(api_token)
+        if catalog is None:
+            catalog = Catalog(packet_utils.connect(api_token), cache_path(), ttl())
+            _catalogs[api_token] = catalog
+        return catalog
+
+
+def validate(defn) -> None:
+    """Reject a PacketDefinition the catalog knows can't be provisioned.
+
+    Called before creating a device.  Failing to read the catalog only
+    skips the validation, the deploy itself will report the actual problem.
+    """
+    try:
+        errors = get(defn.access_key_id).check(defn)
+    except Exception as e:
+        logger.warning("unable to validate machine ‘{0}’: {1}".format(defn.name, e))
+        return
+    if errors:
+        raise Exception(
+            "invalid Packet.net machine ‘{0}’: {1}".format(defn.name, "; ".join(errors))
+        )
+
+
+def select_facilities(defn) -> List[str]:
+    try:
+        return get(defn.access_key_id).select_facilities(defn)
+    except Exception as e:
+        logger.warning("unable to read the facility capacity: {0}".format(e))
+        return [defn.facility]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Incremental reading and journaling of device events.
+
+import calendar
+import json
+import os
+import os.path
+import time
+import packet
+from typing import List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PER_PAGE = 20
+
+
+def parse_timestamp(created_at: Optional[str]) -> Optional[float]:
+    if not created_at:
+        return None
+    return calendar.timegm(time.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+class EventCursor:
+    """Follow the events of a device, fetching only events not seen before.
+
+    The API returns device events newest first, so the cursor walks pages
+    from the top until it reaches the last event id it has seen.  Every new
+    event is appended once to the JSONL journal, if one is given.
+    """
+
+    def __init__(
+        self,
+        manager,
+        device_id: str,
+        last_id: Optional[str] = None,
+        journal: Optional[str] = None,
+    ):
+        self.manager = manager
+        self.device_id = device_id
+        self.last_id = last_id
+        self.journal = journal
+
+    def _fetch(self) -> List[dict]:
+        new: List[dict] = []
+        page = 1
+        while True:
+            data = self.manager.call_api(
+                "devices/%s/events" % self.device_id,
+                params={"page": page, "per_page": EVENTS_PER_PAGE},
+            )
+            for e in data["events"]:
+                if self.last_id is not None and e.get("id") == self.last_id:
+                    return new
+                new.append(e)
+            if not (data.get("meta") or {}).get("next"):
+                return new
+            page += 1
+
+    def _record(self, events: List[dict]) -> None:
+        if not self.journal:
+            return
+        os.makedirs(os.path.dirname(self.journal), exist_ok=True)
+        with open(self.journal, "a") as f:
+            for e in events:
+                record = {
+                    "device": self.device_id,
+                    "id": e.get("id"),
+                    "type": e.get("type"),
+                    "created_at": e.get("created_at"),
+                    "ts": parse_timestamp(e.get("created_at")),
+                    "body": e.get("body"),
+                    "interpolated": e.get("interpolated"),
+                }
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def poll(self) -> List[packet.Event]:
+        """Return the events created since the last poll, oldest first."""
+        new = self._fetch()
+        if not new:
+            return []
+        new.reverse()
+        self._record(new)
+        self.last_id = new[-1].get("id")
+        return [packet.Event(e) for e in new]
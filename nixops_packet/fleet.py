@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+# Operations covering all Packet machines of a deployment at once.
+
+import concurrent.futures
+import os
+import threading
+import time
+import urllib.parse
+import weakref
+import packet
+import nixops_packet.gather as packet_gather
+import nixops_packet.hostkeys as packet_hostkeys
+import nixops_packet.instrument as packet_instrument
+import nixops_packet.poller as packet_poller
+import nixops_packet.utils as packet_utils
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds the first machine being destroyed waits for the others.
+DEFAULT_WINDOW = 2.0
+
+DEFAULT_CONCURRENCY = 16
+
+_destroyers: "weakref.WeakKeyDictionary[Any, BulkDestroyer]" = (
+    weakref.WeakKeyDictionary()
+)
+_reconcilers: "weakref.WeakKeyDictionary[Any, Reconciler]" = (
+    weakref.WeakKeyDictionary()
+)
+_lock = threading.Lock()
+
+
+def bulk_destroy_enabled() -> bool:
+    return os.environ.get("PACKET_BULK_DESTROY", "") not in ("", "0")
+
+
+def concurrency() -> int:
+    return int(os.environ.get("PACKET_DESTROY_CONCURRENCY", DEFAULT_CONCURRENCY))
+
+
+def deployment_devices(machines) -> Dict[Tuple[str, str], Dict[str, packet.Device]]:
+    """List the deployment's devices in every (token, project) of the machines.
+
+    Only devices tagged with the deployment's uuid are listed.
+    """
+    listings: Dict[Tuple[str, str], Dict[str, packet.Device]] = {}
+    for m in machines:
+        if m.vm_id is None or m.project is None or not m.accessKeyId:
+            continue
+        key = (m.accessKeyId, m.project)
+        if key not in listings:
+            devices = packet_utils.list_project_devices(
+                m.connect(),
+                m.project,
+                {"tag": urllib.parse.quote("uuid={0}".format(m.depl.uuid))},
+            )
+            listings[key] = {d.id: d for d in devices}
+    return listings
+
+
+def tagged(device, uuid: str) -> bool:
+    return "uuid={0}".format(uuid) in (device.tags or [])
+
+
+def report_unknown(depl, listings: Dict[Any, Dict[str, Any]]) -> None:
+    """Warn about listed devices tagged with the deployment but unknown to it."""
+    known = set(getattr(m, "vm_id", None) for m in depl.resources.values())
+    for listing in listings.values():
+        for device in listing.values():
+            if tagged(device, depl.uuid) and device.id not in known:
+                depl.logger.warn(
+                    "device {0} ({1}) is tagged with this deployment but unknown to nixops".format(
+                        device.id, device.hostname
+                    )
+                )
+
+
+class BulkDestroyer:
+    """Destroy all Packet machines of a deployment being destroyed together.
+
+    The machines' destroy calls are gathered; the leader lists the projects
+    once, asks a single confirmation, deletes the devices concurrently and
+    reports one summary.  Each machine then gets its own outcome back.
+    """
+
+    def __init__(self, depl, window: float = DEFAULT_WINDOW):
+        self.depl = depl
+        self._gatherer = packet_gather.Gatherer(window, self._destroy_all)
+
+    def destroy(self, machine) -> bool:
+        return self._gatherer.submit(None, machine)
+
+    def _delete(self, machine) -> Tuple[str, Optional[Exception]]:
+        """Delete the device of a machine, returning its outcome class."""
+        with packet_instrument.machine(machine.name):
+            return self._delete_device(machine)
+
+    def _delete_device(self, machine) -> Tuple[str, Optional[Exception]]:
+        if machine.vm_id is None:
+            return ("gone", None)
+        # Even a device missing from the listing is deleted: listings shift
+        # while they are paged through, and the device may be in another
+        # project.  Only the API saying it doesn't exist makes it gone.
+        try:
+            machine.connect().call_api("devices/%s" % machine.vm_id, type="DELETE")
+        except packet.baseapi.Error as e:
+            if e.args[0].startswith("Error 404"):
+                return ("gone", None)
+            elif e.args[0].startswith("Error 403"):
+                return ("unauthorized", e)
+            elif e.args[0].startswith("Error 422"):
+                return ("provisioning", e)
+            return ("failed", e)
+        return ("destroyed", None)
+
+    def _destroy_all(self, key, machines: List[Any]) -> List[Any]:
+        names = sorted(m.name for m in machines)
+        if not self.depl.logger.confirm(
+            "are you sure you want to destroy {0} Packet.net machines ({1})?".format(
+                len(machines), ", ".join(names)
+            )
+        ):
+            return [False] * len(machines)
+
+        listings = deployment_devices(machines)
+        with concurrent.futures.ThreadPoolExecutor(concurrency()) as pool:
+            outcomes = list(pool.map(self._delete, machines))
+
+        by_class: Dict[str, List[str]] = {}
+        for m, (outcome, _) in zip(machines, outcomes):
+            by_class.setdefault(outcome, []).append(m.name)
+        for outcome in sorted(by_class):
+            self.depl.logger.log(
+                "{0} Packet.net machines {1}: {2}".format(
+                    len(by_class[outcome]),
+                    outcome,
+                    ", ".join(sorted(by_class[outcome])),
+                )
+            )
+        report_unknown(self.depl, listings)
+
+        forget_unauthorized = "unauthorized" in by_class and self.depl.logger.confirm(
+            "{0} machines could not be destroyed because of a not-authorized error.\n".format(
+                len(by_class["unauthorized"])
+            )
+            + "This may happen if a machine deployment failed and a machine is later reallocated to another customer's account.\n"
+            + "Do you want to remove these machines from nixops and assume they've already been destroyed?"
+        )
+
+        results: List[Any] = []
+        gone = []
+        with self.depl._db:
+            for m, (outcome, error) in zip(machines, outcomes):
+                if outcome in ("gone", "destroyed") or (
+                    outcome == "unauthorized" and forget_unauthorized
+                ):
+                    gone.append(m)
+                    results.append(True)
+                    continue
+                if outcome == "provisioning":
+                    listing = listings.get((m.accessKeyId, m.project)) or {}
+                    if m.vm_id in listing:
+                        m.state = m.packetstate2state(listing[m.vm_id].state)
+                results.append(error)
+            for m in gone:
+                m.forget_device_state()
+        for m in gone:
+            m.clean_up_device()
+        packet_hostkeys.flush(packet_hostkeys.path(self.depl))
+        return results
+
+
+def destroyer(depl) -> BulkDestroyer:
+    """Return the bulk destroyer of a deployment."""
+    with _lock:
+        d = _destroyers.get(depl)
+        if d is None:
+            d = BulkDestroyer(
+                depl, float(os.environ.get("PACKET_DESTROY_WINDOW", DEFAULT_WINDOW))
+            )
+            _destroyers[depl] = d
+        return d
+
+
+class Reconciler:
+    """Reconcile the Packet machines of a deployment with one device listing.
+
+    The first machine checked lists the devices of every project used by
+    the deployment, through the shared project pollers, and updates the
+    state of all machines from that listing in one transaction.  Machines
+    which went away and devices tagged with the deployment but unknown to
+    it are reported once.  Machines checked later reuse the listing while
+    it is fresh.
+
+    A device missing from a listing is fetched before it is taken as gone:
+    pages shift while a large project is listed, and machines deployed
+    before their project changed are listed under another project.
+    """
+
+    def __init__(self, depl, max_age: float = packet_poller.DEFAULT_MAX_AGE):
+        self.depl = depl
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._listings: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._listed_at: Dict[Tuple[str, str], float] = {}
+        self._reconciled = False
+
+    def _list(self, machine) -> Dict[str, Any]:
+        key = (machine.accessKeyId, machine.project)
+        listed_at = self._listed_at.get(key)
+        if listed_at is None or time.time() - listed_at >= self.max_age:
+            poller = packet_poller.get(machine.connect(), machine.project)
+            self._listings[key] = poller.devices(self.max_age)
+            self._listed_at[key] = time.time()
+        return self._listings[key]
+
+    def device(self, machine):
+        """Return the listed device of a machine, or None if it went away."""
+        with self._lock:
+            if not self._reconciled:
+                # Updates the state of the machine along with all others
+                device = self._reconcile(machine)
+                self._reconciled = True
+                return device
+            device = self._list(machine).get(machine.vm_id)
+        if device is None:
+            device = self._confirm(machine)
+        if device is not None:
+            machine.update_state(device)
+        return device
+
+    def _confirm(self, machine):
+        """Fetch a device missing from its listing; None if it is really gone."""
+        try:
+            device = machine.connect().get_device(machine.vm_id)
+        except packet.baseapi.Error as e:
+            if e.args[0] == "Error 404: Not found":
+                return None
+            raise e
+        packet_poller.get(machine.connect(), machine.project).remember(device)
+        return device
+
+    def _reconcile(self, caller):
+        machines = [
+            m
+            for m in self.depl.resources.values()
+            if isinstance(m, type(caller)) and m.vm_id and m.project and m.accessKeyId
+        ]
+        if caller not in machines:
+            machines.append(caller)
+
+        vanished = []
+        devices = {}
+        with packet_instrument.machine(caller.name):
+            for m in machines:
+                device = self._list(m).get(m.vm_id)
+                if device is None:
+                    try:
+                        device = self._confirm(m)
+                    except packet.baseapi.Error as e:
+                        if m is caller:
+                            raise e
+                        # Left alone, it is checked again on its own
+                        logger.debug("cannot fetch {0}: {1}".format(m.name, e))
+                        continue
+                    if device is None:
+                        vanished.append(m.name)
+                        continue
+                devices[m.name] = device
+        with self.depl._db:
+            for m in machines:
+                if m.name in devices:
+                    m.update_state(devices[m.name])
+
+        if vanished:
+            self.depl.logger.warn(
+                "Packet.net devices of {0} machines went away: {1}".format(
+                    len(vanished), ", ".join(sorted(vanished))
+                )
+            )
+        report_unknown(self.depl, self._listings)
+        logger.debug(
+            "reconciled {0} machines with {1} device listings".format(
+                len(machines), len(self._listings)
+            )
+        )
+        return devices.get(caller.name)
+
+
+def reconciler(depl) -> Reconciler:
+    """Return the reconciler of a deployment."""
+    with _lock:
+        r = _reconcilers.get(depl)
+        if r is None:
+            r = Reconciler(depl)
+            _reconcilers[depl] = r
+        return r
+
+
+def machines_tagged(machines: List[Any], tags: List[str]) -> List[Any]:
+    """Return the machines whose devices carry all of the given tags."""
+    listings = deployment_devices(machines)
+    wanted = set(tags)
+    tagged_machines = []
+    for m in machines:
+        device = listings.get((m.accessKeyId, m.project), {}).get(m.vm_id)
+        if device is not None and wanted <= set(device.tags or []):
+            tagged_machines.append(m)
+    return tagged_machines
+
+
+def reinstall_waves(machines: List[Any], wave_size: int) -> List[List[Any]]:
+    waves: List[List[Any]] = []
+    for m in machines:
+        if not waves or len(waves[-1]) >= wave_size:
+            waves.append([])
+        waves[-1].append(m)
+    return waves
+
+
+def rolling_reinstall(
+    depl,
+    machines: List[Any],
+    wave_size: int,
+    max_concurrent: Optional[int] = None,
+    max_failures: int = 0,
+) -> None:
+    """Reinstall machines in waves, stopping at the first unhealthy wave.
+
+    The machines of a wave are reinstalled in parallel, at most
+    max_concurrent at a time, and wait for their devices through the shared
+    project pollers.  A wave is healthy when no more than max_failures of
+    its machines failed to come back up with SSH and an active device.
+    """
+    waves = reinstall_waves(machines, wave_size)
+    for number, wave in enumerate(waves, 1):
+        depl.logger.log(
+            "reinstalling wave {0}/{1}: {2}".format(
+                number, len(waves), ", ".join(m.name for m in wave)
+            )
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_concurrent or len(wave)) as pool:
+            futures = [(m, pool.submit(m.op_reinstall)) for m in wave]
+
+        failed = []
+        for m, future in futures:
+            error = future.exception()
+            if error is not None:
+                m.warn("reinstall failed: {0}".format(error))
+                failed.append(m.name)
+            elif m.state != m.UP:
+                m.warn("machine is not up after reinstalling")
+                failed.append(m.name)
+        if len(failed) > max_failures:
+            remaining = sum(len(w) for w in waves[number:])
+            raise Exception(
+                "wave {0}/{1} failed its health check ({2}); not reinstalling the remaining {3} machines".format(
+                    number, len(waves), ", ".join(failed), remaining
+                )
+            )
+        depl.logger.log(
+            "wave {0}/{1} reinstalled, {2} failed".format(
+                number, len(waves), len(failed)
+            )
+        )
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Grouping of concurrent per-resource calls into a single fleet operation.
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List
+
+
+class _Pending:
+    def __init__(self, item: Any):
+        self.item = item
+        self.done = threading.Event()
+        self.result: Any = None
+
+
+class Gatherer:
+    """Run calls arriving together from parallel threads as one operation.
+
+    nixops creates and destroys resources from one thread each.  The first
+    caller for a key opens a group and waits ``window`` seconds for other
+    callers with the same key, then runs ``run(key, items)`` once for the
+    whole group.  ``run`` returns one result per item, in order; a result
+    which is an exception is raised in the thread that submitted the item.
+    """
+
+    def __init__(self, window: float, run: Callable[[Any, List[Any]], List[Any]]):
+        self.window = window
+        self.run = run
+        self._lock = threading.Lock()
+        self._groups: Dict[Hashable, List[_Pending]] = {}
+
+    def submit(self, key: Hashable, item: Any) -> Any:
+        pending = _Pending(item)
+        with self._lock:
+            group = self._groups.get(key)
+            leader = group is None
+            if group is None:
+                group = self._groups[key] = []
+            group.append(pending)
+
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                group = self._groups.pop(key)
+            results: List[Any] = []
+            try:
+                results = self.run(key, [p.item for p in group])
+            except Exception as e:
+                results = [e] * len(group)
+            finally:
+                for i, p in enumerate(group):
+                    p.result = (
+                        results[i]
+                        if i < len(results)
+                        else Exception("interrupted while running a group")
+                    )
+                    p.done.set()
+
+        pending.done.wait()
+        if isinstance(pending.result, Exception):
+            raise pending.result
+        return pending.result
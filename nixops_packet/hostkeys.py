@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# Batched maintenance of the known_hosts entries of Packet machines.
+
+import atexit
+import fcntl
+import os
+import os.path
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# (address, public host key, whether to add or remove the address)
+Change = Tuple[str, str, bool]
+
+_pending: Dict[str, List[Change]] = {}
+_lock = threading.Lock()
+# Held while rewriting, so that changes are applied in the order queued
+_flush_lock = threading.Lock()
+_registered = False
+
+
+def batched() -> bool:
+    return os.environ.get("PACKET_KNOWN_HOSTS_BATCH", "1") != "0"
+
+
+def deployment_scoped() -> bool:
+    return os.environ.get("PACKET_KNOWN_HOSTS", "") == "deployment"
+
+
+def path(depl) -> str:
+    """Return the known_hosts file holding the host keys of a deployment."""
+    if deployment_scoped():
+        return os.path.join(
+            os.path.dirname(os.path.abspath(depl._db.db_file)),
+            "packet-known-hosts",
+            depl.uuid,
+        )
+    return os.path.expanduser("~/.ssh/known_hosts")
+
+
+def _queue(depl, changes: List[Change]) -> None:
+    global _registered
+    known_hosts = path(depl)
+    with _lock:
+        _pending.setdefault(known_hosts, []).extend(changes)
+        if not _registered:
+            atexit.register(flush)
+            _registered = True
+    if not batched():
+        flush(known_hosts)
+
+
+def add(depl, address: Optional[str], public_host_key: Optional[str]) -> None:
+    if address and public_host_key:
+        _queue(depl, [(address, public_host_key, True)])
+
+
+def remove(depl, address: Optional[str], public_host_key: Optional[str]) -> None:
+    if address and public_host_key:
+        _queue(depl, [(address, public_host_key, False)])
+
+
+def update(
+    depl,
+    prev_address: Optional[str],
+    new_address: Optional[str],
+    public_host_key: Optional[str],
+) -> None:
+    """Move the entry of a host key from one address to another."""
+    if prev_address is not None and prev_address != new_address:
+        remove(depl, prev_address, public_host_key)
+    add(depl, new_address, public_host_key)
+
+
+def flush(known_hosts: Optional[str] = None) -> None:
+    """Apply the pending changes, one rewrite per known_hosts file.
+
+    Changes queued by other threads while a file is being rewritten are
+    picked up by the next flush.
+    """
+    with _flush_lock:
+        with _lock:
+            if known_hosts is None:
+                batches = list(_pending.items())
+                _pending.clear()
+            else:
+                batches = [(known_hosts, _pending.pop(known_hosts, []))]
+        for file, changes in batches:
+            if changes:
+                rewrite(file, changes)
+
+
+def apply(lines: List[str], changes: List[Change]) -> List[str]:
+    """Apply changes to the lines of a known_hosts file.
+
+    Comments, hashed host names and marker lines are kept as they are.
+    """
+    entries: List[Tuple[Optional[List[str]], str]] = []
+    for line in lines:
+        if " " not in line or line[0] in "#|@":
+            entries.append((None, line))
+        else:
+            names, rest = line.split(" ", 1)
+            entries.append((names.split(","), rest))
+
+    for address, key, adding in changes:
+        found = False
+        for entry_names, rest in entries:
+            if entry_names is not None and rest.strip() == key:
+                found = True
+                if adding and address not in entry_names:
+                    entry_names.append(address)
+                elif not adding and address in entry_names:
+                    entry_names.remove(address)
+        if adding and not found:
+            entries.append(([address], key + "\n"))
+
+    return [
+        rest if entry_names is None else ",".join(entry_names) + " " + rest
+        for entry_names, rest in entries
+        # Entries whose last address was removed are dropped
+        if entry_names is None or entry_names
+    ]
+
+
+def rewrite(known_hosts: str, changes: List[Change]) -> None:
+    """Atomically rewrite a known_hosts file, under the lock nixops uses."""
+    directory = os.path.dirname(known_hosts)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    with open(os.path.join(directory, ".known_hosts.lock"), "w") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            with open(known_hosts) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        tmp = known_hosts + ".tmp"
+        with open(tmp, "w") as f:
+            f.writelines(apply(lines, changes))
+        os.replace(tmp, known_hosts)
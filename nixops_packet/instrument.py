@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Per-call instrumentation of the Packet API client.
+
+import atexit
+import contextlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+_UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+_records: List[Dict[str, Any]] = []
+_lock = threading.Lock()
+_local = threading.local()
+_run = "{0}-{1}".format(int(time.time()), os.getpid())
+
+
+def report_path() -> Optional[str]:
+    return os.environ.get("PACKET_API_REPORT") or None
+
+
+def enabled() -> bool:
+    return report_path() is not None
+
+
+def set_machine(name: Optional[str]) -> None:
+    """Attribute the API calls of the current thread to a machine."""
+    _local.machine = name
+
+
+def current_machine() -> Optional[str]:
+    return getattr(_local, "machine", None)
+
+
+@contextlib.contextmanager
+def machine(name: Optional[str]):
+    previous = current_machine()
+    set_machine(name)
+    try:
+        yield
+    finally:
+        set_machine(previous)
+
+
+def endpoint(method: str, path: str) -> str:
+    """Return the endpoint of a call, with object ids replaced by {id}."""
+    return "{0} {1}".format(method, _UUID.sub("{id}", path))
+
+
+def record(
+    method: str,
+    path: str,
+    status: Optional[int],
+    latency: float,
+    retries: int,
+    size: int,
+) -> None:
+    with _lock:
+        if not _records:
+            atexit.register(write_report)
+        _records.append(
+            {
+                "run": _run,
+                "ts": time.time(),
+                "machine": current_machine(),
+                "endpoint": endpoint(method, path),
+                "status": status,
+                "latency": round(latency, 4),
+                "retries": retries,
+                "bytes": size,
+            }
+        )
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def summarize(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    by_endpoint: Dict[str, List[Dict[str, Any]]] = {}
+    for r in records:
+        by_endpoint.setdefault(r["endpoint"], []).append(r)
+    summary = []
+    for name, calls in sorted(by_endpoint.items()):
+        latencies = sorted(c["latency"] for c in calls)
+        summary.append(
+            {
+                "run": _run,
+                "endpoint": name,
+                "calls": len(calls),
+                "errors": sum(
+                    1 for c in calls if not c["status"] or c["status"] >= 400
+                ),
+                "retries": sum(c["retries"] for c in calls),
+                "bytes": sum(c["bytes"] for c in calls),
+                "total": round(sum(latencies), 4),
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1],
+            }
+        )
+    return summary
+
+
+def write_report(path: Optional[str] = None) -> None:
+    """Append the recorded calls and their summary to the JSONL report."""
+    path = path or report_path()
+    with _lock:
+        records = list(_records)
+        del _records[:]
+    if not path or not records:
+        return
+    summary = summarize(records)
+    with open(path, "a") as f:
+        for r in records:
+            f.write(json.dumps(dict(r, type="call")) + "\n")
+        for s in summary:
+            f.write(json.dumps(dict(s, type="summary")) + "\n")
+
+    sys.stderr.write(
+        "Packet API: {0} calls, {1:.1f}s total; report written to {2}\n".format(
+            len(records), sum(s["total"] for s in summary), path
+        )
+    )
+    for s in sorted(summary, key=lambda s: -s["total"]):
+        sys.stderr.write(
+            "  {0:<40} {1:>5} calls {2:>8.1f}s  p50 {3:.3f}s  p99 {4:.3f}s\n".format(
+                s["endpoint"], s["calls"], s["total"], s["p50"], s["p99"]
+            )
+        )
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+# Deferred imports, keeping the plugin cheap to load for the many nixops
+# commands which never touch a Packet resource.
+
+import importlib
+import threading
+import types
+from typing import Optional
+
+
+class LazyModule(types.ModuleType):
+    """A module imported on first use of one of its attributes.
+
+    Unlike importlib.util.LazyLoader this is safe when several threads use
+    the module for the first time at once, as nixops deploys machines from
+    parallel threads.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._lazy_lock = threading.Lock()
+        self._lazy_module: Optional[types.ModuleType] = None
+
+    def _load(self) -> types.ModuleType:
+        with self._lazy_lock:
+            if self._lazy_module is None:
+                self._lazy_module = importlib.import_module(self.__name__)
+            return self._lazy_module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+
+def module(name: str) -> types.ModuleType:
+    """Return the named module, to be imported when first used."""
+    return LazyModule(name)
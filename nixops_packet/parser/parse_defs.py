@@ -1,12 +1,15 @@
 #! /usr/bin/env python2
 # -*- coding: utf-8 -*-
 
+import json
 import nixops.script_defs
-from nixops_packet.backends.device import PacketState
 from typing import cast
 
 
 def op_sos_console(args):
+    # The backend is only loaded for the subcommands using it
+    from nixops_packet.backends.device import PacketState
+
     with nixops.script_defs.deployment(args) as depl:
         m = depl.machines.get(args.machine)
         if not m:
@@ -15,10 +18,13 @@ def op_sos_console(args):
             raise Exception(
                 "machine is not a Packet device: ‘{0}’".format(args.machine)
             )
-        cast(PacketState, m).op_sos_console()
+        cast(PacketState, m).op_sos_console(refresh=args.refresh, offline=args.offline)
 
 
 def op_update_provision(args):
+    # The backend is only loaded for the subcommands using it
+    from nixops_packet.backends.device import PacketState
+
     with nixops.script_defs.deployment(args) as depl:
         m = depl.machines.get(args.machine)
         if not m:
@@ -30,13 +36,95 @@ def op_update_provision(args):
         cast(PacketState, m).op_update_provSystem()
 
 
+def select_machines(depl, args, machine_type):
+    """Return the Packet machines named, tagged or, with --all, all of them."""
+    import nixops_packet.fleet as packet_fleet
+
+    machines = sorted(
+        (m for m in depl.machines.values() if isinstance(m, machine_type)),
+        key=lambda m: m.name,
+    )
+    if args.all:
+        return machines
+    selected = {}
+    for name in args.machines:
+        m = depl.machines.get(name)
+        if not m:
+            raise Exception("unknown machine ‘{0}’".format(name))
+        if not isinstance(m, machine_type):
+            raise Exception("machine is not a Packet device: ‘{0}’".format(name))
+        selected[name] = m
+    if args.tags:
+        for m in packet_fleet.machines_tagged(machines, args.tags):
+            selected[m.name] = m
+    if not selected:
+        raise Exception(
+            "no machines selected; name machines, or use ‘--tag’ or ‘--all’"
+        )
+    return [selected[name] for name in sorted(selected)]
+
+
 def op_reinstall(args):
+    from nixops_packet.backends.device import PacketState
+    import nixops_packet.fleet as packet_fleet
+
     with nixops.script_defs.deployment(args) as depl:
-        m = depl.machines.get(args.machine)
-        if not m:
-            raise Exception("unknown machine ‘{0}’".format(args.machine))
-        if not isinstance(m, PacketState):
-            raise Exception(
-                "machine is not a Packet device: ‘{0}’".format(args.machine)
+        machines = select_machines(depl, args, PacketState)
+        if len(machines) > 1 and not depl.logger.confirm(
+            "are you sure you want to reinstall {0} Packet.net machines ({1})?".format(
+                len(machines), ", ".join(m.name for m in machines)
             )
-        cast(PacketState, m).op_reinstall()
+        ):
+            return
+        packet_fleet.rolling_reinstall(
+            depl,
+            machines,
+            wave_size=args.wave_size,
+            max_concurrent=args.max_concurrent,
+            max_failures=args.max_failures,
+        )
+
+
+def op_timings(args):
+    from nixops_packet.backends.device import PacketState
+    import nixops_packet.timings as packet_timings
+
+    with nixops.script_defs.deployment(args) as depl:
+        records = [
+            (m.name, dict(m.timings, facility=m.facility_code or m.timings["facility"]))
+            for m in sorted(depl.machines.values(), key=lambda m: m.name)
+            if isinstance(m, PacketState) and m.timings is not None
+        ]
+        if args.json:
+            for name, record in records:
+                print(json.dumps(dict(record, machine=name), sort_keys=True))
+        elif records:
+            print("\n".join(packet_timings.report(records)))
+
+
+def op_fill_pool(args):
+    from nixops_packet.backends.device import PacketDefinition
+    import nixops_packet.pool as packet_pool
+    import nixops_packet.resources.keypair as packet_keypair
+    import nixops_packet.utils as packet_utils
+
+    if not packet_pool.enabled():
+        raise Exception("set PACKET_WARM_POOL to the number of spares to keep")
+    with nixops.script_defs.deployment(args) as depl:
+        depl.evaluate()
+        filled = set()
+        for defn in depl.definitions.values():
+            if not isinstance(defn, PacketDefinition):
+                continue
+            kp = packet_keypair.keypair_index(depl).keypair(defn.key_pair)
+            if kp is None or kp.keypair_id is None:
+                # The key pair isn't deployed yet
+                continue
+            key = packet_pool.pool_key(defn, kp.keypair_id)
+            if key is None or key in filled:
+                continue
+            filled.add(key)
+            depl.logger.log("filling pool {0}".format(key))
+            packet_pool.get(
+                packet_utils.connect(defn.access_key_id), defn.project
+            ).fill(key, packet_pool.spare_args(defn, kp.keypair_id), kp.private_key)
@@ -36,6 +36,17 @@ class NixopsPACKETPlugin(Plugin):
         plugin_command.add_argument(
             "machine", metavar="MACHINE", help="identifier of the machine"
         )
+        group = plugin_command.add_mutually_exclusive_group()
+        group.add_argument(
+            "--refresh",
+            action="store_true",
+            help="refresh the machine's facts from the Packet API first",
+        )
+        group.add_argument(
+            "--offline",
+            action="store_true",
+            help="only use the facts recorded in the state, never the Packet API",
+        )
         nixops.script_defs.add_common_deployment_options(plugin_command)
 
         plugin_command = nixops.script_defs.add_subparser(
@@ -58,7 +69,63 @@ class NixopsPACKETPlugin(Plugin):
         )
         plugin_command.set_defaults(op=nixops_packet.parser.parse_defs.op_reinstall)
         plugin_command.add_argument(
-            "machine", metavar="MACHINE", help="identifier of the machine"
+            "machines",
+            metavar="MACHINE",
+            nargs="*",
+            help="identifier of a machine to reinstall",
+        )
+        plugin_command.add_argument(
+            "--tag",
+            dest="tags",
+            metavar="KEY=VALUE",
+            action="append",
+            default=[],
+            help="reinstall the machines whose device has this tag",
+        )
+        plugin_command.add_argument(
+            "--all", action="store_true", help="reinstall all Packet machines"
+        )
+        plugin_command.add_argument(
+            "--wave-size",
+            type=int,
+            default=1,
+            metavar="N",
+            help="number of machines reinstalled per wave (default: 1)",
+        )
+        plugin_command.add_argument(
+            "--max-concurrent",
+            type=int,
+            default=None,
+            metavar="N",
+            help="maximum number of machines of a wave reinstalled at once",
+        )
+        plugin_command.add_argument(
+            "--max-failures",
+            type=int,
+            default=0,
+            metavar="N",
+            help="number of machines of a wave allowed to fail before the rollout stops (default: 0)",
+        )
+        nixops.script_defs.add_common_deployment_options(plugin_command)
+
+        plugin_command = nixops.script_defs.add_subparser(
+            plugin_cmd_subparsers,
+            "fill-pool",
+            help="capture the spare devices of the warm pools and create missing ones",
+        )
+        plugin_command.set_defaults(op=nixops_packet.parser.parse_defs.op_fill_pool)
+        nixops.script_defs.add_common_deployment_options(plugin_command)
+
+        plugin_command = nixops.script_defs.add_subparser(
+            plugin_cmd_subparsers,
+            "timings",
+            help="report how long the bring-up phases of the machines took",
+        )
+        plugin_command.set_defaults(op=nixops_packet.parser.parse_defs.op_timings)
+        plugin_command.add_argument(
+            "--json",
+            action="store_true",
+            help="print the recorded milestones of every machine as JSON lines",
         )
         nixops.script_defs.add_common_deployment_options(plugin_command)
 
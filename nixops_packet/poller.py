@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Project wide device polling shared by all machines of a process.
+
+import threading
+import time
+import nixops_packet.utils as packet_utils
+from typing import Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Snapshots younger than this are handed out without another listing.
+DEFAULT_MAX_AGE = 10
+
+_pollers: Dict[Tuple[str, str], "ProjectPoller"] = {}
+_pollers_lock = threading.Lock()
+
+
+class ProjectPoller:
+    """Serve device snapshots of one project from a shared device listing.
+
+    Every machine waiting on its device asks the poller instead of calling
+    get_device itself.  The first caller finding the snapshot older than
+    the requested age lists all project devices (one call per page) while
+    the others block on the lock and then reuse the fresh listing.
+
+    Devices fetched one by one are remembered as well, so that back to
+    back lookups of a device are answered locally.  Snapshots of devices
+    which were just changed (reinstalled, deleted) are invalidated.
+    """
+
+    def __init__(self, manager, project_id: str):
+        self.manager = manager
+        self.project_id = project_id
+        self._lock = threading.Lock()
+        self._devices: Dict[str, object] = {}
+        # When the snapshot of each device was taken, None once invalidated
+        self._taken_at: Dict[str, Optional[float]] = {}
+        self._fetched_at: Optional[float] = None
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        devices = packet_utils.list_project_devices(self.manager, self.project_id)
+        self._fetched_at = time.time()
+        self._devices = {d.id: d for d in devices}
+        self._taken_at = {d.id: self._fetched_at for d in devices}
+        logger.debug(
+            "project {0}: listed {1} devices".format(self.project_id, len(devices))
+        )
+
+    def _ensure_fresh(self, max_age: float) -> None:
+        if self._fetched_at is None or time.time() - self._fetched_at >= max_age:
+            self._refresh()
+
+    def _fresh(self, device_id: str, max_age: float):
+        taken_at = self._taken_at.get(device_id)
+        if taken_at is None or time.time() - taken_at >= max_age:
+            return None
+        return self._devices[device_id]
+
+    def devices(self, max_age: float = DEFAULT_MAX_AGE) -> Dict[str, object]:
+        """Return the snapshots of all project devices, by device id."""
+        with self._lock:
+            self._ensure_fresh(max_age)
+            return dict(self._devices)
+
+    def device(self, device_id: str, max_age: float = DEFAULT_MAX_AGE):
+        """Return a snapshot of a device, or None if none is fresh enough.
+
+        Callers fetch the device themselves (and remember it) when None is
+        returned.
+        """
+        with self._lock:
+            device = self._fresh(device_id, max_age)
+            if device is None:
+                self._ensure_fresh(max_age)
+                device = self._fresh(device_id, max_age)
+            return device
+
+    def remember(self, device) -> None:
+        """Keep a snapshot of a device fetched or created outside a listing."""
+        with self._lock:
+            self._devices[device.id] = device
+            self._taken_at[device.id] = time.time()
+
+    def invalidate(self, device_id: str) -> None:
+        """Stop handing out the snapshot of a device which is being changed."""
+        with self._lock:
+            if device_id in self._taken_at:
+                self._taken_at[device_id] = None
+
+    def discard(self, device_id: str) -> None:
+        """Forget a deleted device."""
+        with self._lock:
+            self._devices.pop(device_id, None)
+            self._taken_at.pop(device_id, None)
+
+
+def get(manager, project_id: str) -> ProjectPoller:
+    """Return the process wide poller for a project."""
+    key = (manager.auth_token, project_id)
+    with _pollers_lock:
+        poller = _pollers.get(key)
+        if poller is None:
+            poller = ProjectPoller(manager, project_id)
+            _pollers[key] = poller
+        return poller
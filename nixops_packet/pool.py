@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+# Warm pool of provisioned spare devices, claimed by machines instead of
+# creating and provisioning a device of their own.
+
+import fcntl
+import json
+import os
+import os.path
+import subprocess
+import tempfile
+import threading
+import uuid
+import packet
+import nixops_packet.poller as packet_poller
+import nixops_packet.provision as packet_provision
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Spare devices carry this tag, valued with the key of their pool.
+POOL_TAG = "nixops-packet-pool"
+
+SSH_TIMEOUT = 120
+
+_pools: Dict[Tuple[str, str], "WarmPool"] = {}
+_lock = threading.Lock()
+# Refills run one at a time
+_refill_lock = threading.Lock()
+
+
+def size() -> int:
+    return int(os.environ.get("PACKET_WARM_POOL", 0))
+
+
+def enabled() -> bool:
+    return size() > 0
+
+
+def capture_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "nixops-packet", "pool")
+
+
+def pool_key(defn, keypair_id: str) -> Optional[str]:
+    """Return the pool a machine draws its device from, None if it can't.
+
+    Only plain devices are pooled: custom data, storage layouts, iPXE
+    scripts, spot instances and reservations make a device specific to its
+    machine.
+    """
+    if (
+        defn.ipxe_script_url
+        or defn.customData is not None
+        or defn.storage is not None
+        or defn.spotInstance
+        or defn.reservationId
+        or defn.always_pxe
+    ):
+        return None
+    return "/".join([defn.plan, defn.facility, defn.operating_system, keypair_id])
+
+
+def spare_args(defn, keypair_id: str) -> Dict[str, Any]:
+    """Return the create_device arguments of a spare for a machine definition."""
+    return dict(
+        project_id=defn.project,
+        plan=defn.plan,
+        facility=[defn.facility],
+        operating_system=defn.operating_system,
+        user_ssh_keys=[],
+        project_ssh_keys=[keypair_id],
+    )
+
+
+def public_ipv4(device) -> Optional[str]:
+    for address in device.ip_addresses:
+        if address["public"] and address["address_family"] == 4:
+            return address["address"]
+    return None
+
+
+def capture(address: str, private_key: str) -> str:
+    """Capture the provisioning state of a spare device over SSH."""
+    with tempfile.NamedTemporaryFile("w", prefix="nixops-packet-pool-") as f:
+        os.chmod(f.name, 0o600)
+        f.write(private_key)
+        f.flush()
+        return subprocess.run(
+            [
+                "ssh",
+                "-i",
+                f.name,
+                "-o",
+                "BatchMode=yes",
+                "-o",
+                "ConnectTimeout=10",
+                # Spares are first contacted here, like new machines by nixops
+                "-o",
+                "StrictHostKeyChecking=no",
+                "-o",
+                "UserKnownHostsFile=/dev/null",
+                "root@" + address,
+                packet_provision.CAPTURE_SCRIPT,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            timeout=SSH_TIMEOUT,
+            check=True,
+        ).stdout
+
+
+def adopt(capture, spare_hostname: str, hostname: str, tags: List[str]):
+    """Make the capture of a spare describe the machine which claimed it.
+
+    Returns None if the captured metadata can't be adjusted, in which case
+    the machine's provisioning state has to be captured again.
+    """
+    try:
+        metadata = json.loads(capture.metadata)
+    except ValueError:
+        return None
+    metadata["hostname"] = hostname
+    metadata["tags"] = tags
+    capture.metadata = json.dumps(metadata)
+    capture.files = {
+        name: text.replace(spare_hostname, hostname)
+        for name, text in capture.files.items()
+    }
+    return capture
+
+
+class WarmPool:
+    """The spare devices of one project, grouped into pools by pool_key.
+
+    Spares are created with the plan, facility, operating system and
+    project SSH key of the machines of their pool, and their captured
+    provisioning state is kept in capture_dir() until they are claimed.
+    Claiming retags the device with the tags and hostname of the machine.
+
+    Claims are serialized by a lock file in capture_dir(), so a pool may
+    only be shared by nixops processes running on the same host as the
+    same user.
+    """
+
+    def __init__(self, manager, project_id: str):
+        self.manager = manager
+        self.project_id = project_id
+        self._lock = threading.Lock()
+
+    def spares(self, key: str, max_age: float = packet_poller.DEFAULT_MAX_AGE):
+        tag = "{0}={1}".format(POOL_TAG, key)
+        devices: Dict[str, Any] = packet_poller.get(
+            self.manager, self.project_id
+        ).devices(max_age)
+        return sorted(
+            (d for d in devices.values() if tag in (d.tags or [])),
+            key=lambda d: d.created_at,
+        )
+
+    def _capture_file(self, device_id: str) -> str:
+        return os.path.join(capture_dir(), device_id)
+
+    def claim(
+        self, key: str, hostname: str, tags: List[str]
+    ) -> Optional[Tuple[Any, Any]]:
+        """Take an active spare for a machine.
+
+        Returns the device and its captured provisioning state, adopted by
+        the machine (None if it was never captured), or None if the pool has
+        no active spare.
+        """
+        poller = packet_poller.get(self.manager, self.project_id)
+        spare_tag = "{0}={1}".format(POOL_TAG, key)
+        os.makedirs(capture_dir(), mode=0o700, exist_ok=True)
+        with self._lock, open(os.path.join(capture_dir(), ".claim.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for spare in self.spares(key):
+                if spare.state != "active":
+                    continue
+                try:
+                    # The listing may predate a claim by another process
+                    spare = self.manager.get_device(spare.id)
+                    if spare_tag not in (spare.tags or []):
+                        continue
+                    self.manager.call_api(
+                        "devices/%s" % spare.id,
+                        type="PUT",
+                        params={"hostname": hostname, "tags": tags},
+                    )
+                    device = self.manager.get_device(spare.id)
+                except packet.baseapi.Error as e:
+                    logger.debug("cannot claim spare {0}: {1}".format(spare.id, e))
+                    continue
+                poller.remember(device)
+                return device, self._take_capture(spare, hostname, tags)
+        return None
+
+    def _take_capture(self, spare, hostname: str, tags: List[str]):
+        path = self._capture_file(spare.id)
+        try:
+            with open(path) as f:
+                text = f.read()
+            os.remove(path)
+            return adopt(
+                packet_provision.parse_capture(text), spare.hostname, hostname, tags
+            )
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.debug("discarding the capture of {0}: {1}".format(spare.id, e))
+            return None
+
+    def refill(self, key: str, args: Dict[str, Any], private_key: str) -> None:
+        """Top up a pool in the background, without holding up exit.
+
+        args are the create_device arguments of a spare, see spare_args.
+        """
+        threading.Thread(
+            target=self.fill, args=(key, args, private_key), daemon=True
+        ).start()
+
+    def fill(self, key: str, args: Dict[str, Any], private_key: str) -> None:
+        """Capture the active spares of a pool and create the missing ones."""
+        with _refill_lock:
+            try:
+                self._fill(key, args, private_key)
+            except Exception as e:
+                logger.warning("refilling pool {0} failed: {1}".format(key, e))
+
+    def _fill(self, key: str, args: Dict[str, Any], private_key: str) -> None:
+        live = []
+        for spare in self.spares(key, max_age=0):
+            if spare.state == "failed":
+                self.manager.call_api("devices/%s" % spare.id, type="DELETE")
+                continue
+            live.append(spare)
+            address = public_ipv4(spare)
+            captured = os.path.exists(self._capture_file(spare.id))
+            if spare.state == "active" and address and not captured:
+                self._capture(spare.id, address, private_key)
+
+        missing = size() - len(live)
+        if missing > 0:
+            logger.debug("creating {0} spare devices for pool {1}".format(missing, key))
+        for _ in range(missing):
+            self.manager.create_device(
+                **dict(
+                    args,
+                    hostname="nixops-spare-{0}".format(uuid.uuid4().hex[:8]),
+                    tags=["{0}={1}".format(POOL_TAG, key)],
+                )
+            )
+
+    def _capture(self, device_id: str, address: str, private_key: str) -> None:
+        try:
+            output = capture(address, private_key)
+            packet_provision.parse_capture(output)
+        except Exception as e:
+            logger.debug("cannot capture spare {0}: {1}".format(device_id, e))
+            return
+        os.makedirs(capture_dir(), mode=0o700, exist_ok=True)
+        tmp = self._capture_file(device_id) + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(output)
+        os.replace(tmp, self._capture_file(device_id))
+
+
+def get(manager, project_id: str) -> WarmPool:
+    """Return the process wide warm pool of a project."""
+    key = (manager.auth_token, project_id)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = WarmPool(manager, project_id)
+            _pools[key] = pool
+        return pool
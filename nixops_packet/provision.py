@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Capture of the provisioning state of a device in a single SSH round trip.
+
+import base64
+import fnmatch
+import io
+import os
+import os.path
+import re
+import tarfile
+from typing import Dict, Optional
+
+MARKER = "@@nixops-packet@@"
+
+# Everything update_provSystem needs from a freshly provisioned machine,
+# printed as marker separated sections.  The nix files left by the
+# provisioning script are sent as a base64 encoded tar stream.  A failed
+# metadata fetch fails the whole capture, like the separate commands do;
+# the host key and nix files may be missing.
+CAPTURE_SCRIPT = "; ".join(
+    [
+        "set -e",
+        "M={0}".format(MARKER),
+        'echo "$M metadata"',
+        "curl -fsSL https://metadata.packet.net/metadata",
+        "echo",
+        'echo "$M host-key"',
+        "cat /etc/ssh/ssh_host_ed25519_key.pub 2>/dev/null || true",
+        'echo "$M boot-uuid"',
+        "lsblk -o uuid,mountpoint 2>/dev/null | grep '/boot/efi' | cut -d' ' -f1 | tr -d '\\n'",
+        "echo",
+        'echo "$M files"',
+        "(cd /etc/nixos/packet 2>/dev/null && tar -cf - *.nix 2>/dev/null | base64 -w0) || true",
+        "echo",
+        'echo "$M end"',
+    ]
+)
+
+
+def enabled() -> bool:
+    return os.environ.get("PACKET_SINGLE_CAPTURE", "") not in ("", "0")
+
+
+class Capture:
+    """The provisioning files and facts of a device, as captured remotely."""
+
+    def __init__(
+        self, metadata: str, host_key: str, boot_uuid: str, files: Dict[str, str]
+    ):
+        self.metadata = metadata
+        self.host_key = host_key
+        self.boot_uuid = boot_uuid
+        self.files = files
+
+
+def parse_capture(output: str) -> Capture:
+    sections: Dict[str, str] = {}
+    name: Optional[str] = None
+    lines: list = []
+    for line in output.split("\n"):
+        if line.startswith(MARKER + " "):
+            if name is not None:
+                sections[name] = "\n".join(lines)
+            name = line.split(" ", 1)[1].strip()
+            lines = []
+        else:
+            lines.append(line)
+    if name != "end":
+        raise Exception("incomplete provisioning capture")
+    if not sections.get("metadata", "").strip():
+        raise Exception("provisioning capture without device metadata")
+
+    files: Dict[str, str] = {}
+    encoded = sections.get("files", "").strip()
+    if encoded:
+        with tarfile.open(fileobj=io.BytesIO(base64.b64decode(encoded))) as tar:
+            for member in tar.getmembers():
+                f = tar.extractfile(member)
+                if f is not None:
+                    files[os.path.basename(member.name)] = f.read().decode()
+
+    return Capture(
+        metadata=sections.get("metadata", ""),
+        host_key=sections.get("host-key", "").strip(),
+        boot_uuid=sections.get("boot-uuid", "").strip(),
+        files=files,
+    )
+
+
+def assemble_legacy_system(files: Dict[str, str]) -> str:
+    """Build system.nix from the nix files left by a legacy provisioning script."""
+    names = sorted(n for n in files if fnmatch.fnmatch(n, "*-*.nix"))
+    if "metadata.nix" in files:
+        names.append("metadata.nix")
+    return (
+        "{ imports = [\n" + "".join("(\n" + files[n] + ")\n" for n in names) + "]; }\n"
+    )
+
+
+def strip_legacy_credentials(system: str) -> str:
+    """Drop root's authorized keys and initialHashedPassword definitions."""
+    out = []
+    in_keys = False
+    for line in system.split("\n"):
+        if in_keys:
+            in_keys = not re.search(r"\s+\];", line)
+            continue
+        if "users.users.root.openssh.authorizedKeys.keys = [" in line:
+            in_keys = not re.search(r"\s+\];", line)
+            continue
+        if "users.users.root.initialHashedPassword" in line:
+            continue
+        out.append(line)
+    return "\n".join(out)
+
+
+def patch_bond_mac(system: str, mac: str) -> str:
+    """Set the physical nic MAC address on a bond interface, if defined.
+
+    Works around https://github.com/NixOS/nixpkgs/issues/69360
+    """
+    return re.sub(
+        r"(\s+networking.interfaces.bond0 = \{(\s+)useDHCP = false;)\s+",
+        lambda m: '{0}{1}macAddress = "{2}";\n'.format(
+            m.group(1), m.group(2), mac.strip()
+        ),
+        system,
+    )
+
+
+def patch_boot_uuid(system: str, uuid: str) -> str:
+    """Refer to the /boot/efi device by UUID instead of by name."""
+    return re.sub(
+        r'("/boot/efi" = \{[^\n]*\n[^\n]*?)/dev/sda1',
+        lambda m: "{0}/dev/disk/by-uuid/{1}".format(m.group(1), uuid),
+        system,
+    )
+
+
+def strip_comments(system: str) -> str:
+    return "\n".join(
+        line for line in system.splitlines() if not line.lstrip().startswith("#")
+    )
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Content addressed storage of captured system.nix files.
+
+import hashlib
+import threading
+from nixops.nix_expr import nix2py
+from typing import Any, Dict, Optional
+
+ATTR_PREFIX = "packet.provSystem."
+
+# Machines of the same plan and image mostly capture the very same
+# system.nix, so the text and its parsed form are kept once per digest.
+_texts: Dict[str, str] = {}
+_parsed: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+
+def digest(text: str) -> str:
+    return "sha256-" + hashlib.sha256(text.encode()).hexdigest()
+
+
+def store(depl, text: str) -> str:
+    """Store a system.nix in the deployment and return its digest."""
+    d = digest(text)
+    with _lock:
+        _texts[d] = text
+    if depl._get_attr(ATTR_PREFIX + d, None) is None:
+        depl._set_attr(ATTR_PREFIX + d, text)
+    return d
+
+
+def load(depl, d: str) -> Optional[str]:
+    with _lock:
+        text = _texts.get(d)
+    if text is None:
+        text = depl._get_attr(ATTR_PREFIX + d, None)
+        if text is not None:
+            with _lock:
+                _texts[d] = text
+    return text
+
+
+def parse(d: str, text: str) -> Any:
+    """Return nix2py of a stored system.nix, parsed once per digest.
+
+    The result is shared between machines and must not be modified.
+    """
+    with _lock:
+        if d in _parsed:
+            return _parsed[d]
+    value = nix2py(text)
+    with _lock:
+        _parsed[d] = value
+    return value
+
+
+def release(depl, d: str) -> None:
+    """Drop a system.nix from the deployment, once no machine refers to it."""
+    for r in depl.resources.values():
+        if getattr(r, "provSystem_hash", None) == d:
+            return
+    depl._set_attr(ATTR_PREFIX + d, None)
+    with _lock:
+        _texts.pop(d, None)
+        _parsed.pop(d, None)
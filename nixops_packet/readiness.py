@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Non-blocking SSH readiness probes for all machines of a process.
+
+import asyncio
+import concurrent.futures
+import os
+import random
+import threading
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+INITIAL_DELAY = 1.0
+MAX_DELAY = 30.0
+PROBE_TIMEOUT = 5.0
+
+_waiter: Optional["ReadinessWaiter"] = None
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.environ.get("PACKET_ASYNC_SSH_WAIT", "1") != "0"
+
+
+async def probe(host: str, port: int, timeout: float = PROBE_TIMEOUT) -> bool:
+    """Return whether an SSH server answers with its banner on host:port."""
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        banner = await asyncio.wait_for(reader.readline(), timeout)
+        return banner.startswith(b"SSH-")
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+async def wait_until_ready(
+    host: str, port: int, initial: float = INITIAL_DELAY, maximum: float = MAX_DELAY
+) -> None:
+    delay = initial
+    while not await probe(host, port):
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * 2, maximum)
+    logger.debug("{0}:{1} is accepting SSH connections".format(host, port))
+
+
+class ReadinessWaiter:
+    """Probe the SSH ports of all pending machines from one event loop.
+
+    Machines are deployed from parallel threads; instead of each of them
+    blocking on its own connection attempts, they submit their address
+    here and wait on the returned future, which completes as soon as that
+    particular machine presents an SSH banner.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="packet-ssh-readiness", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, host: str, port: int) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(
+            wait_until_ready(host, port), self._loop
+        )
+
+
+def get() -> ReadinessWaiter:
+    """Return the process wide readiness waiter."""
+    global _waiter
+    with _lock:
+        if _waiter is None:
+            _waiter = ReadinessWaiter()
+        return _waiter
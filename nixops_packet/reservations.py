@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Assignment of hardware reservations to machines asking for the
+# "next-available" one.
+
+import threading
+import weakref
+import nixops_packet.utils as packet_utils
+from typing import Any, Dict, List, Set, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+NEXT_AVAILABLE = "next-available"
+
+_assigners: "weakref.WeakKeyDictionary[Any, Assigner]" = weakref.WeakKeyDictionary()
+_assigners_lock = threading.Lock()
+
+
+def list_reservations(manager, project_id: str) -> List[Dict[str, Any]]:
+    return packet_utils.list_all(
+        manager,
+        "projects/%s/hardware-reservations" % project_id,
+        "hardware_reservations",
+    )
+
+
+def matches(reservation: Dict[str, Any], defn) -> bool:
+    """Return whether a reservation can hold a device of a machine definition."""
+    plan = (reservation.get("plan") or {}).get("slug")
+    facility = (reservation.get("facility") or {}).get("code")
+    return plan == defn.plan and defn.facility in (facility, "any")
+
+
+class Assigner:
+    """Hand out the hardware reservations of a deployment's projects.
+
+    Machines created in parallel with reservationId "next-available" would
+    all ask the API for the same free reservation.  Instead the first of
+    them lists the reservations of its project once and assigns a distinct
+    provisionable reservation to every machine of the deployment still
+    waiting for a device, in the order of their names.  Assignments are
+    recorded in the state of the machines so that a later deployment
+    reuses them while they are still free.
+    """
+
+    def __init__(self, depl):
+        self.depl = depl
+        self._lock = threading.Lock()
+        # (token, project) -> provisionable reservations, by id
+        self._free: Dict[Tuple[str, str], Dict[str, Dict[str, Any]]] = {}
+
+    def reservation(self, machine, defn) -> Tuple[str, str]:
+        """Return the reservation id and facility assigned to a machine."""
+        key = (defn.access_key_id, defn.project)
+        with self._lock:
+            if key not in self._free:
+                reservations = list_reservations(machine.connect(), defn.project)
+                self._free[key] = {
+                    r["id"]: r for r in reservations if r.get("provisionable")
+                }
+                self._assign_all(machine, defn)
+            free = self._free[key]
+            # Keeps the assignment unless the machine wasn't pending when
+            # the others were assigned and its reservation went elsewhere
+            self._assign(machine, defn, free, self._taken(machine))
+            reservation = free.get(machine.reservation_id)
+            if reservation is None:
+                raise Exception(
+                    "no provisionable hardware reservation of plan ‘{0}’ in facility ‘{1}’ left for ‘{2}’".format(
+                        defn.plan, defn.facility, machine.name
+                    )
+                )
+            return reservation["id"], reservation["facility"]["code"]
+
+    def _taken(self, caller) -> Set[str]:
+        """Return the reservations assigned to the other machines."""
+        return {
+            m.reservation_id
+            for m in self.depl.resources.values()
+            if isinstance(m, type(caller)) and m is not caller and m.reservation_id
+        }
+
+    def _assign(self, machine, defn, free, taken: Set[str]) -> None:
+        if machine.reservation_id in free and machine.reservation_id not in taken:
+            return
+        for reservation_id in sorted(free):
+            if reservation_id not in taken and matches(free[reservation_id], defn):
+                machine.reservation_id = reservation_id
+                taken.add(reservation_id)
+                return
+        machine.reservation_id = None
+
+    def _assign_all(self, caller, defn) -> None:
+        definitions = getattr(self.depl, "definitions", None) or {}
+        pending = [
+            m
+            for m in self.depl.resources.values()
+            if isinstance(m, type(caller))
+            and m.vm_id is None
+            and getattr(definitions.get(m.name), "reservationId", None)
+            == NEXT_AVAILABLE
+            and definitions[m.name].access_key_id == defn.access_key_id
+            and definitions[m.name].project == defn.project
+        ]
+        if caller not in pending:
+            pending.append(caller)
+        pending.sort(key=lambda m: m.name)
+        pending_names = {m.name for m in pending}
+
+        free = self._free[(defn.access_key_id, defn.project)]
+        # Reservations of machines which already have a device, or which
+        # aren't part of this round, stay theirs
+        taken = {
+            m.reservation_id
+            for m in self.depl.resources.values()
+            if isinstance(m, type(caller))
+            and m.name not in pending_names
+            and m.reservation_id
+        }
+        with self.depl._db:
+            # Keep the assignments of earlier deployments which are still free
+            for m in pending:
+                if m.reservation_id in free and m.reservation_id not in taken:
+                    taken.add(m.reservation_id)
+                else:
+                    m.reservation_id = None
+            for m in pending:
+                if m.reservation_id is None:
+                    m_defn = defn if m is caller else definitions[m.name]
+                    self._assign(m, m_defn, free, taken)
+        logger.debug(
+            "assigned hardware reservations to {0} machines: {1}".format(
+                len(pending), {m.name: m.reservation_id for m in pending}
+            )
+        )
+
+
+def assigner(depl) -> Assigner:
+    """Return the reservation assigner of a deployment."""
+    with _assigners_lock:
+        a = _assigners.get(depl)
+        if a is None:
+            a = Assigner(depl)
+            _assigners[depl] = a
+        return a
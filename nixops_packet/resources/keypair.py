@@ -4,15 +4,24 @@
 
 import nixops.util
 import nixops.resources
-import nixops_packet.utils as packet_utils
+import nixops_packet.lazy as packet_lazy
 import nixops_packet.backends.device
-import packet
 import os
-from typing import cast, Optional, Any
+import threading
+import weakref
+from typing import cast, Dict, List, Optional, Any
 import logging
 
 logger = logging.getLogger(__name__)
 
+packet = packet_lazy.module("packet")
+packet_instrument = packet_lazy.module("nixops_packet.instrument")
+packet_sshkeys = packet_lazy.module("nixops_packet.sshkeys")
+packet_utils = packet_lazy.module("nixops_packet.utils")
+
+_indexes: "weakref.WeakKeyDictionary[Any, KeypairIndex]" = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
 
 class PacketKeyPairOptions(nixops.resources.ResourceOptions):
     name: str
@@ -47,6 +56,73 @@ class PacketKeyPairDefinition(nixops.resources.ResourceDefinition):
         self.project = self.config.project
 
 
+class KeypairIndex:
+    """Keypairs of a deployment by name, and the machines using each of them.
+
+    The index is built from active_resources on first use and whenever it
+    has been invalidated, i.e. after a keypair was uploaded or destroyed or
+    a machine was bound to a keypair.  Entries are re-checked on lookup, so
+    resources which have since been removed or went down are never returned.
+    """
+
+    def __init__(self, depl):
+        self.depl = depl
+        self._lock = threading.Lock()
+        self._keypairs: Optional[Dict[str, "PacketKeyPairState"]] = None
+        self._machines: Dict[str, List[Any]] = {}
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._keypairs = None
+
+    def _build(self) -> Dict[str, "PacketKeyPairState"]:
+        keypairs: Dict[str, PacketKeyPairState] = {}
+        machines: Dict[str, List[Any]] = {}
+        for r in self.depl.active_resources.values():
+            if isinstance(r, PacketKeyPairState):
+                if r.state == PacketKeyPairState.UP:
+                    keypairs.setdefault(r.keypair_name, r)
+            elif isinstance(r, nixops_packet.backends.device.PacketState):
+                if r.key_pair is not None:
+                    machines.setdefault(r.key_pair, []).append(r)
+        self._keypairs = keypairs
+        self._machines = machines
+        return keypairs
+
+    def _current(self, r) -> bool:
+        return not r.obsolete and self.depl.resources.get(r.name) is r
+
+    def keypair(self, name: Optional[str]) -> Optional["PacketKeyPairState"]:
+        with self._lock:
+            keypairs = self._keypairs if self._keypairs is not None else self._build()
+            key = keypairs.get(name) if name is not None else None
+        if (
+            key is not None
+            and key.keypair_name == name
+            and key.state == PacketKeyPairState.UP
+            and self._current(key)
+        ):
+            return key
+        return None
+
+    def machines(self, name: str) -> List[Any]:
+        with self._lock:
+            if self._keypairs is None:
+                self._build()
+            machines = list(self._machines.get(name, []))
+        return [m for m in machines if m.key_pair == name and self._current(m)]
+
+
+def keypair_index(depl) -> KeypairIndex:
+    """Return the keypair index of a deployment."""
+    with _indexes_lock:
+        index = _indexes.get(depl)
+        if index is None:
+            index = KeypairIndex(depl)
+            _indexes[depl] = index
+        return index
+
+
 class PacketKeyPairState(nixops.resources.ResourceState[PacketKeyPairDefinition]):
     """State of a Packet.net key pair."""
 
@@ -73,6 +149,7 @@ class PacketKeyPairState(nixops.resources.ResourceState[PacketKeyPairDefinition]
         return "resources.packetKeyPairs."
 
     def connect(self):
+        packet_instrument.set_machine(self.name)
         if self._conn is None:
             self._conn = packet_utils.connect(self.access_key_id)
 
@@ -105,37 +182,34 @@ class PacketKeyPairState(nixops.resources.ResourceState[PacketKeyPairDefinition]
         # Upload the public key to Packet.net.
         self.state: Any
         if check or self.state != self.UP:
-
-            try:
-                kp = self._connection().get_ssh_key(self.keypair_id)
-            except packet.baseapi.Error as e:
-                if e.args[0] == "Error 404: Not found":
-                    kp = None
-                else:
-                    raise e
-
-            # Don't re-upload the key if it exists and we're just checking.
-            if not kp or self.state != self.UP:
-                if kp:
-                    kp.delete()
+            keys = packet_sshkeys.get(self._connection(), self.project)
+            kp = keys.find(self.keypair_id, self.public_key)
+
+            # Only touch keys which differ from ours
+            if kp is not None and not packet_sshkeys.same_key(kp, self.public_key):
+                self.log("replacing Packet key pair ‘{0}’...".format(defn.keypair_name))
+                try:
+                    keys.delete(kp.id)
+                except packet.baseapi.Error as e:
+                    if e.args[0] != "Error 404: Not found":
+                        raise e
+                kp = None
+            if kp is None:
                 self.log("uploading Packet key pair ‘{0}’...".format(defn.keypair_name))
-                kp = self._connection().create_project_ssh_key(
-                    self.project, defn.keypair_name, self.public_key
-                )
-                self.keypair_id = kp.id
+                kp = keys.upload(defn.keypair_name, self.public_key)
 
             with self.depl._db:
+                self.keypair_id = kp.id
                 self.state = self.UP
                 self.keypair_name = defn.keypair_name
+            keypair_index(self.depl).invalidate()
 
     def destroy(self, wipe: bool = False) -> bool:
         def keypair_used() -> Optional[nixops_packet.backends.device.PacketState]:
-            for m in self.depl.active_resources.values():
-                if isinstance(m, nixops_packet.backends.device.PacketState):
-                    device = cast(nixops_packet.backends.device.PacketState, m)
-                    if device.key_pair == self.keypair_name:
-                        return device
-            return None
+            machines = keypair_index(self.depl).machines(self.keypair_name)
+            if not machines:
+                return None
+            return cast(nixops_packet.backends.device.PacketState, machines[0])
 
         m = keypair_used()
         if m:
@@ -154,8 +228,9 @@ class PacketKeyPairState(nixops.resources.ResourceState[PacketKeyPairDefinition]
                 self.log(
                     "deleting Packet.net key pair ‘{0}’...".format(self.keypair_name)
                 )
-                kp = self._connection().get_ssh_key(self.keypair_id)
-                kp.delete()
+                packet_sshkeys.get(self._connection(), self.project).delete(
+                    self.keypair_id
+                )
         except packet.baseapi.Error as e:
             print(e.args[0])
             if e.args[0] == "Error 404: Not found":
@@ -165,4 +240,5 @@ class PacketKeyPairState(nixops.resources.ResourceState[PacketKeyPairDefinition]
                 )
             else:
                 raise e
+        keypair_index(self.depl).invalidate()
         return True
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Polling intervals and the API request budget shared by all machines.
+
+import email.utils
+import random
+import threading
+import time
+from typing import Mapping, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = 5
+DEFAULT_INTERVAL = 10
+MAX_INTERVAL = 30
+
+# Relative jitter applied to every interval so machines created together
+# don't poll in lock step.
+JITTER = 0.2
+
+# Default sustained API request rate (per second) for one access token.
+DEFAULT_RATE = 10.0
+
+# Below this many remaining calls the budget spreads the rest of the quota
+# evenly over the time left until it resets.
+LOW_REMAINING = 50
+
+
+def poll_interval(state: str, percentage: Optional[float] = None) -> float:
+    """Return the number of seconds to wait before polling a device again.
+
+    Devices leave ‘queued’ quickly, then spend most of their time in the
+    middle of ‘provisioning’, and finish with a short burst near 100%.
+    """
+    if state == "queued":
+        base = MIN_INTERVAL
+    elif state == "provisioning":
+        if not percentage or percentage < 10:
+            base = DEFAULT_INTERVAL
+        elif percentage < 80:
+            base = MAX_INTERVAL
+        elif percentage < 95:
+            base = DEFAULT_INTERVAL
+        else:
+            base = MIN_INTERVAL
+    else:
+        base = DEFAULT_INTERVAL
+    return base * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RateBudget:
+    """A token bucket shared by every thread using one API token.
+
+    Besides the configured rate, the bucket follows the API's own view of
+    the quota: Retry-After pauses every caller, and a low
+    X-RateLimit-Remaining spreads the remaining calls over the time left
+    until X-RateLimit-Reset.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._spacing = 0.0
+        self._last_call = 0.0
+        self._lock = threading.Lock()
+
+    def _next_slot(self, now: float) -> float:
+        """Return the delay before a call may be issued, or 0 and take a token."""
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._spacing and now - self._last_call < self._spacing:
+            return self._spacing - (now - self._last_call)
+        if self.rate > 0:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self._last_call = now
+        return 0.0
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                delay = self._next_slot(time.monotonic())
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                logger.debug("API rate limited, pausing for {0:.1f}s".format(seconds))
+                self._paused_until = until
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """Adjust the budget from the rate limit headers of a response."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            left = int(remaining)
+            reset_in = float(reset)
+        except ValueError:
+            return
+        # The reset may be given either as an epoch or as a delta
+        if reset_in > 1e9:
+            reset_in = reset_in - time.time()
+        reset_in = max(0.0, reset_in)
+        if left <= 0:
+            self.pause(reset_in)
+        with self._lock:
+            self._spacing = reset_in / left if 0 < left < LOW_REMAINING else 0.0
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Project SSH keys, listed once for all keypairs of a process.
+
+import base64
+import binascii
+import hashlib
+import threading
+import time
+import packet
+import nixops_packet.utils as packet_utils
+from typing import Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Listings younger than this are reused by other keypairs.
+DEFAULT_MAX_AGE = 10
+
+_listings: Dict[Tuple[str, str], "ProjectKeys"] = {}
+_lock = threading.Lock()
+
+
+def fingerprint(public_key: str) -> Optional[str]:
+    """Return the MD5 fingerprint of an OpenSSH public key, as Packet shows it."""
+    try:
+        blob = base64.b64decode(public_key.split()[1])
+    except (IndexError, binascii.Error):
+        return None
+    digest = hashlib.md5(blob).hexdigest()
+    return ":".join(digest[i : i + 2] for i in range(0, len(digest), 2))  # noqa: E203
+
+
+def same_key(key: packet.SSHKey, public_key: str) -> bool:
+    """Return whether an uploaded key holds the given public key."""
+    if key.key and key.key.split()[:2] == public_key.split()[:2]:
+        return True
+    return key.fingerprint is not None and key.fingerprint == fingerprint(public_key)
+
+
+class ProjectKeys:
+    """The SSH keys of one project, from a single shared listing.
+
+    Keypairs deployed together look their key up here instead of fetching
+    it one by one.  Keys uploaded or deleted through this object are
+    reflected in the listing without listing the project again.
+    """
+
+    def __init__(self, manager, project_id: str):
+        self.manager = manager
+        self.project_id = project_id
+        self._lock = threading.Lock()
+        self._keys: Dict[str, packet.SSHKey] = {}
+        self._fetched_at: Optional[float] = None
+
+    def keys(self, max_age: float = DEFAULT_MAX_AGE) -> Dict[str, packet.SSHKey]:
+        with self._lock:
+            if self._fetched_at is None or time.time() - self._fetched_at >= max_age:
+                keys = packet_utils.list_all(
+                    self.manager, "projects/%s/ssh-keys" % self.project_id, "ssh_keys"
+                )
+                self._keys = {k["id"]: packet.SSHKey(k, self.manager) for k in keys}
+                self._fetched_at = time.time()
+                logger.debug(
+                    "project {0}: listed {1} SSH keys".format(
+                        self.project_id, len(self._keys)
+                    )
+                )
+            return dict(self._keys)
+
+    def find(self, key_id: Optional[str], public_key: str) -> Optional[packet.SSHKey]:
+        """Return the uploaded key with this id, else one holding public_key."""
+        keys = self.keys()
+        if key_id in keys:
+            return keys[key_id]
+        for key in keys.values():
+            if same_key(key, public_key):
+                return key
+        return None
+
+    def upload(self, label: str, public_key: str) -> packet.SSHKey:
+        key = self.manager.create_project_ssh_key(self.project_id, label, public_key)
+        with self._lock:
+            self._keys[key.id] = key
+        return key
+
+    def delete(self, key_id: str) -> None:
+        self.manager.call_api("ssh-keys/%s" % key_id, type="DELETE")
+        with self._lock:
+            self._keys.pop(key_id, None)
+
+
+def get(manager, project_id: str) -> ProjectKeys:
+    """Return the process wide SSH key listing of a project."""
+    key = (manager.auth_token, project_id)
+    with _lock:
+        keys = _listings.get(key)
+        if keys is None:
+            keys = ProjectKeys(manager, project_id)
+            _listings[key] = keys
+        return keys
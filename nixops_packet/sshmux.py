@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Persistent SSH connection multiplexing for Packet machines.
+
+import glob
+import hashlib
+import os
+import os.path
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import nixops.ssh_util
+from typing import List, Optional
+
+DEFAULT_PERSIST = 600
+
+# Seconds between attempts to start a master connection
+RETRY_INTERVAL = 3
+
+# Seconds to wait for the socket of a started master to appear
+START_TIMEOUT = 60
+
+# The control directory checked last, so that it is only checked once
+_checked: Optional[str] = None
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.environ.get("PACKET_SSH_MULTIPLEX", "") not in ("", "0")
+
+
+def persist() -> int:
+    return int(os.environ.get("PACKET_SSH_PERSIST", DEFAULT_PERSIST))
+
+
+def control_dir() -> str:
+    # Kept short: unix socket paths are limited to about 100 characters
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "nixops-packet")
+    return os.path.join(tempfile.gettempdir(), "nixops-packet-{0}".format(os.getuid()))
+
+
+def ensure_control_dir() -> str:
+    """Create the control directory, refusing one that isn't private to us.
+
+    Anyone able to create the directory in a shared location beforehand
+    could otherwise take over the master connections.
+    """
+    global _checked
+    path = control_dir()
+    with _lock:
+        if _checked != path:
+            try:
+                os.mkdir(path, 0o700)
+            except FileExistsError:
+                pass
+            st = os.lstat(path)
+            if (
+                not stat.S_ISDIR(st.st_mode)
+                or st.st_uid != os.getuid()
+                or stat.S_IMODE(st.st_mode) != 0o700
+            ):
+                raise Exception(
+                    "refusing to use ‘{0}’ for SSH control sockets: it must be a directory owned by the current user with mode 0700".format(
+                        path
+                    )
+                )
+            _checked = path
+    return path
+
+
+def control_prefix(uuid: str, name: str, public_host_key: Optional[str]) -> str:
+    """Return the socket prefix of a machine, bound to its current host key."""
+    key = hashlib.sha1(
+        "{0}/{1}/{2}".format(uuid, name, public_host_key or "").encode()
+    ).hexdigest()[:16]
+    return os.path.join(control_dir(), key)
+
+
+def socket_path(prefix: str, target: str) -> str:
+    """Return the control socket of a machine's connections to target."""
+    return "{0}-{1}".format(prefix, hashlib.sha1(target.encode()).hexdigest()[:8])
+
+
+def check(path: str, target: str) -> bool:
+    """Return whether a master connection is listening on the socket."""
+    return (
+        os.path.exists(path)
+        and subprocess.call(
+            ["ssh", "-S", path, "-O", "check", target],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        == 0
+    )
+
+
+class PersistentMaster(nixops.ssh_util.SSHMaster):
+    """A master connection shared by successive nixops invocations.
+
+    Stands in for nixops' own master, whose socket lives in a temporary
+    directory of the process.  This one is kept in control_dir() and left
+    running by shutdown(): it exits after persist() idle seconds, or when
+    close() is called.  Only the interface nixops.ssh_util.SSH uses is
+    provided, so the parent's constructor isn't called.
+    """
+
+    def __init__(self, path: str, target: str, flags: List[str]):
+        self._control_socket = path
+        self.opts = ["-oControlPath={0}".format(path)]
+        # Whether the master of an earlier invocation was found running
+        self.reused = check(path, target)
+        if self.reused:
+            return
+        if os.path.lexists(path):
+            # Left by a master which died: ssh won't listen on it
+            os.remove(path)
+        res = subprocess.run(
+            [
+                "ssh",
+                "-x",
+                target,
+                "-S",
+                path,
+                "-M",
+                "-N",
+                "-f",
+                "-oServerAliveInterval=60",
+                "-oControlPersist={0}".format(persist()),
+            ]
+            + flags,
+            check=False,
+        )
+        if res.returncode != 0:
+            raise Exception(
+                "unable to start SSH master connection to ‘{0}’".format(target)
+            )
+        deadline = time.time() + START_TIMEOUT
+        while not self.is_alive():
+            if time.time() > deadline:
+                raise Exception(
+                    "SSH master connection to ‘{0}’ didn't come up".format(target)
+                )
+            time.sleep(0.1)
+
+    def is_alive(self) -> bool:
+        return os.path.exists(self._control_socket)
+
+    def shutdown(self) -> None:
+        """Leave the master running for the next invocations."""
+
+    def __del__(self) -> None:
+        pass
+
+
+class MultiplexedSSH(nixops.ssh_util.SSH):
+    """nixops' SSH, with its master connections persisted across invocations.
+
+    prefix_fun returns the control socket prefix of the machine, see
+    control_prefix.  Every command, file copy and closure copy nixops runs
+    through get_master() then uses the persistent socket.
+    """
+
+    _ssh_master: Optional[nixops.ssh_util.SSHMaster]
+
+    def __init__(self, logger, prefix_fun):
+        super().__init__(logger)
+        self._prefix_fun = prefix_fun
+
+    def get_master(self, flags=[], timeout=None, tries=5, user=None):
+        if self._ssh_master is not None and self._ssh_master.is_alive():
+            return self._ssh_master
+        flags = flags + self._get_flags()
+        if timeout is not None:
+            flags = flags + ["-o", "ConnectTimeout={0}".format(timeout)]
+            tries = 1
+        ensure_control_dir()
+        target = self._get_target(user)
+        path = socket_path(self._prefix_fun(), target)
+        while True:
+            try:
+                self._ssh_master = PersistentMaster(path, target, flags)
+                return self._ssh_master
+            except Exception:
+                tries -= 1
+                if tries <= 0:
+                    raise
+                time.sleep(RETRY_INTERVAL)
+
+
+def close(prefix: str) -> None:
+    """Stop the master connections of a machine and remove their sockets."""
+    for path in glob.glob(prefix + "-*"):
+        subprocess.call(
+            ["ssh", "-o", "ControlPath=" + path, "-O", "exit", "packet"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Timing of the phases of a machine's bring-up, kept in its state.
+
+import time
+import nixops_packet.instrument as packet_instrument
+from typing import Any, Dict, List, Optional, Tuple
+
+# Milestones of a bring-up, in the order they are reached.
+PHASES = ["created", "queued", "provisioning", "active", "ssh-up", "captured"]
+
+# Reported durations: (name, from milestone, to milestone)
+SPANS = [
+    ("queue", "created", "provisioning"),
+    ("provision", "provisioning", "active"),
+    ("ssh", "active", "ssh-up"),
+    ("capture", "ssh-up", "captured"),
+    ("total", "created", "captured"),
+]
+
+
+def start(kind: str, plan: Optional[str], facility: Optional[str]) -> Dict[str, Any]:
+    """Return a new timing record for a device being created or reinstalled."""
+    return {
+        "kind": kind,
+        "plan": plan,
+        "facility": facility,
+        "phases": {"created": round(time.time(), 3)},
+        # [timestamp, provisioning percentage] whenever the percentage moved
+        "progress": [],
+        "done": False,
+    }
+
+
+def mark(record: Dict[str, Any], phase: str) -> bool:
+    """Note when a milestone was first reached; return whether it is new."""
+    if record["done"] or phase in record["phases"]:
+        return False
+    record["phases"][phase] = round(time.time(), 3)
+    if phase == "captured":
+        record["done"] = True
+    return True
+
+
+def progress(record: Dict[str, Any], percentage: Optional[float]) -> bool:
+    """Note the provisioning percentage; return whether it changed."""
+    if record["done"] or percentage is None:
+        return False
+    if record["progress"] and record["progress"][-1][1] == percentage:
+        return False
+    record["progress"].append([round(time.time(), 3), percentage])
+    return True
+
+
+def durations(record: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    phases = record["phases"]
+    spans: Dict[str, Optional[float]] = {}
+    for name, begin, end in SPANS:
+        if begin in phases and end in phases and phases[end] >= phases[begin]:
+            spans[name] = round(phases[end] - phases[begin], 1)
+        else:
+            spans[name] = None
+    return spans
+
+
+def _format(value: Optional[float]) -> str:
+    return "-" if value is None else "{0:.1f}".format(value)
+
+
+def report(records: List[Tuple[str, Dict[str, Any]]]) -> List[str]:
+    """Return the lines of a report of (machine name, record) pairs.
+
+    Lists the durations of every machine, then p50, p95 and max of every
+    duration per kind of bring-up, plan and facility, since claiming a
+    spare takes a fraction of a creation.  Bring-ups which didn't finish
+    have their kind starred.
+    """
+    names = [name for name, _, _ in SPANS]
+    header = "{0:<24} {1:<10} {2:<16} {3:<8}".format(
+        "machine", "kind", "plan", "facility"
+    ) + "".join(" {0:>9}".format(n) for n in names)
+    lines = [header]
+    groups: Dict[Tuple[str, str, str], List[Dict[str, Optional[float]]]] = {}
+    for machine, record in records:
+        spans = durations(record)
+        lines.append(
+            "{0:<24} {1:<10} {2:<16} {3:<8}".format(
+                machine,
+                record["kind"] + ("" if record["done"] else "*"),
+                record["plan"] or "-",
+                record["facility"] or "-",
+            )
+            + "".join(" {0:>9}".format(_format(spans[n])) for n in names)
+        )
+        key = (record["kind"], record["plan"] or "-", record["facility"] or "-")
+        groups.setdefault(key, []).append(spans)
+
+    lines.append("")
+    lines.append(
+        "{0:<10} {1:<16} {2:<8} {3:>8} {4:<10}".format(
+            "kind", "plan", "facility", "machines", "span"
+        )
+        + "".join(" {0:>9}".format(s) for s in ["p50", "p95", "max"])
+    )
+    for (kind, plan, facility), spans_list in sorted(groups.items()):
+        for n in names:
+            values: List[float] = sorted(
+                v for v in (s[n] for s in spans_list) if v is not None
+            )
+            if not values:
+                continue
+            lines.append(
+                "{0:<10} {1:<16} {2:<8} {3:>8} {4:<10}".format(
+                    kind, plan, facility, len(values), n
+                )
+                + "".join(
+                    " {0:>9}".format(_format(v))
+                    for v in [
+                        packet_instrument.percentile(values, 50),
+                        packet_instrument.percentile(values, 95),
+                        values[-1],
+                    ]
+                )
+            )
+    return lines
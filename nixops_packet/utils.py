@@ -1,10 +1,218 @@
 # -*- coding: utf-8 -*-
 
+import json
+import os
+import threading
+import time
 import packet
+import requests
+import requests.adapters
+import nixops_packet.instrument as packet_instrument
+import nixops_packet.scheduler as packet_scheduler
+from typing import Dict, Optional
+
+# Maximum number of keep-alive connections held open per API token.  All
+# resources of a deployment sharing a token are deployed from parallel
+# threads, so this is also the number of concurrent in-flight API calls.
+DEFAULT_POOL_SIZE = 32
+
+# Number of times a call answered with HTTP 429 is retried.
+MAX_RETRIES = 5
+
+# Page size used when walking paginated collections such as project devices.
+DEFAULT_PER_PAGE = 250
+
+_managers: Dict[str, "PacketManager"] = {}
+_managers_lock = threading.Lock()
+
+
+class PacketManager(packet.Manager):
+    """A packet.Manager which issues its calls over a pooled keep-alive session.
+
+    The stock packet.BaseAPI uses the module level requests functions, which
+    open a new HTTPS connection (and TLS handshake) for every call.  This
+    subclass routes the same calls through a single requests.Session so that
+    it can be shared between all resources and threads using the same token.
+    Calls are paced by a RateBudget shared by all of these threads.
+    """
+
+    def __init__(
+        self, auth_token, pool_size=DEFAULT_POOL_SIZE, rate=None, api_url=None
+    ):
+        super().__init__(auth_token=auth_token)
+        self.api_url = api_url or "https://" + self.end_point
+        self.budget = packet_scheduler.RateBudget(
+            packet_scheduler.DEFAULT_RATE if rate is None else rate
+        )
+        self._local = threading.local()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    # packet.BaseAPI stores pagination info of the last call on the instance;
+    # keep it per thread since the manager is shared.
+    @property
+    def meta(self):
+        return getattr(self._local, "meta", None)
+
+    @meta.setter
+    def meta(self, value):
+        self._local.meta = value
+
+    @property
+    def response_headers(self):
+        """Headers of the last response received by the calling thread."""
+        return getattr(self._local, "response_headers", {})
+
+    def _request(self, type, url, headers, params):
+        if type == "GET":
+            return self.session.get(url + self._parse_params(params), headers=headers)
+        elif type == "POST":
+            return self.session.post(
+                url,
+                headers=headers,
+                data=json.dumps(
+                    params, default=lambda o: o.__dict__, sort_keys=True, indent=4
+                ),
+            )
+        elif type == "DELETE":
+            return self.session.delete(url, headers=headers)
+        elif type == "PATCH":
+            return self.session.patch(url, headers=headers, data=json.dumps(params))
+        elif type == "PUT":
+            return self.session.put(url, headers=headers, data=json.dumps(params))
+        raise packet.baseapi.Error(
+            "method type not recognized as one of GET, POST, DELETE, PATCH or PUT: %s"
+            % type
+        )
+
+    def call_api(self, method, type="GET", params=None, headers=None):
+        if params is None:
+            params = {}
+        extra_headers = headers or {}
+
+        url = self.api_url + "/" + method
+        headers = {
+            "X-Auth-Token": self.auth_token,
+            "X-Consumer-Token": self.consumer_token,
+            "Content-Type": "application/json",
+            "User-Agent": self.user_agent,
+        }
+        headers.update(extra_headers)
+
+        headers_str = str(headers).replace(self.auth_token.strip(), "TOKEN")
+        self._log.debug("%s %s %s %s" % (type, url, params, headers_str))
+        started = time.monotonic()
+        resp = None
+        attempt = 0
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                self.budget.acquire()
+                try:
+                    resp = self._request(type, url, headers, params)
+                except requests.exceptions.RequestException as e:
+                    raise packet.baseapi.Error("Communcations error: %s" % str(e), e)
+                self.budget.update(resp.headers)
+                self._local.response_headers = resp.headers
+                if resp.status_code != 429 or attempt == MAX_RETRIES:
+                    break
+                retry_after = packet_scheduler.parse_retry_after(
+                    resp.headers.get("Retry-After")
+                )
+                self.budget.pause(
+                    retry_after if retry_after is not None else 2 ** attempt
+                )
+        finally:
+            if packet_instrument.enabled():
+                packet_instrument.record(
+                    type,
+                    method,
+                    None if resp is None else resp.status_code,
+                    time.monotonic() - started,
+                    attempt,
+                    0 if resp is None else len(resp.content or b""),
+                )
+
+        assert resp is not None
+        if not resp.content:
+            data = None
+        elif resp.headers.get("content-type", "").startswith("application/json"):
+            try:
+                data = resp.json()
+            except ValueError as e:
+                raise packet.baseapi.JSONReadError("Read failed: %s" % e, e)
+        else:
+            data = resp.content
+
+        if not resp.ok:
+            raise packet.baseapi.ResponseError(resp, data)
+
+        self.meta = None
+        if isinstance(data, dict) and data.get("meta"):
+            self.meta = data["meta"]
+
+        return data
+
+    def fetch(self, method, etag=None):
+        """GET a resource unless it still matches etag.
+
+        Returns the data (None if unchanged) and the current etag.
+        """
+        data = self.call_api(method, headers={"If-None-Match": etag} if etag else None)
+        return data, self.response_headers.get("ETag", etag)
+
+
+def pool_size() -> int:
+    return int(os.environ.get("PACKET_API_POOL_SIZE", DEFAULT_POOL_SIZE))
+
+
+def rate() -> float:
+    return float(os.environ.get("PACKET_API_RATE", packet_scheduler.DEFAULT_RATE))
+
+
+def api_url() -> Optional[str]:
+    return os.environ.get("PACKET_API_URL") or None
 
 
 def connect(api_token):
-    return packet.Manager(auth_token=api_token)
+    """Return the process wide API client for the given token."""
+    with _managers_lock:
+        manager = _managers.get(api_token)
+        if manager is None:
+            manager = PacketManager(
+                auth_token=api_token,
+                pool_size=pool_size(),
+                rate=rate(),
+                api_url=api_url(),
+            )
+            _managers[api_token] = manager
+        return manager
+
+
+def list_all(manager, path, key, params=None, per_page=DEFAULT_PER_PAGE):
+    """Return every item of a paginated collection, one call per page."""
+    items = []
+    page = 1
+    while True:
+        query = dict(params or {})
+        query.update({"page": page, "per_page": per_page})
+        data = manager.call_api(path, params=query)
+        items.extend(data[key])
+        if not (data.get("meta") or {}).get("next"):
+            return items
+        page += 1
+
+
+def list_project_devices(manager, project_id, params=None):
+    return [
+        packet.Device(d, manager)
+        for d in list_all(
+            manager, "projects/%s/devices" % project_id, "devices", params
+        )
+    ]
 
 
 def dict2tags(data):